@@ -0,0 +1,182 @@
+"""
+本地模拟的公众号文章服务器, 性能测试时代替 mp.weixin.qq.com
+
+文章链接: /s?__biz=<账号>&mid=<编号>&idx=1&sn=<哈希>
+- 编号能被 4 整除的是长文章, 其余是短文章
+- 正文图片使用 data-src 懒加载, 每 5 张图片中有 1 张是慢速图片
+- 编号能被 verify_every 整除的文章第一次访问时跳转到验证页面
+
+单独运行: python -m benchmark.fixture_server --port 8765
+"""
+import time
+import zlib
+import struct
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+
+SHORT_PARAGRAPHS = 8
+LONG_PARAGRAPHS = 120
+IMAGES_PER_PARAGRAPHS = 4
+SLOW_IMAGE_EVERY = 5
+SLOW_IMAGE_DELAY = 1.5
+# 多篇文章共用的公众号头像、横幅和二维码
+SHARED_IMAGES = ("logo", "banner", "qrcode")
+
+STYLE = b"""
+body { font-family: sans-serif; margin: 0 auto; max-width: 680px; }
+.rich_media_content { line-height: 1.75; font-size: 17px; }
+.rich_media_content img { max-width: 100%; display: block; margin: 12px auto; }
+"""
+
+ARTICLE_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<meta property="og:url" content="{url}">
+<title>{title}</title>
+<link rel="stylesheet" href="/res/style.css">
+</head>
+<body>
+<h1 class="rich_media_title" id="activity-name">{title}</h1>
+<div class="rich_media_meta_list"><img src="/img/logo.png?wx_fmt=png" width="40"> {nickname}</div>
+<div class="rich_media_content" id="js_content" style="visibility: hidden;">
+<img data-src="/img/banner.png?wx_fmt=png">
+{body}
+<img data-src="/img/qrcode.png?wx_fmt=png">
+</div>
+<script>
+var msg_link = "{url}";
+document.getElementById("js_content").style.visibility = "visible";
+</script>
+</body>
+</html>
+"""
+
+VERIFY_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>验证</title></head>
+<body><p>环境异常</p><p>完成验证后即可继续访问</p></body></html>
+"""
+
+
+def make_png(seed: str, size: int = 64) -> bytes:
+    """
+    根据 seed 生成内容不同的纯色 PNG
+    """
+    color = hashlib.md5(seed.encode("utf-8")).digest()[:3]
+    row = b"\x00" + color * size
+    raw = row * size
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b"")
+
+
+def article_url(base_url: str, account: int, mid: int) -> str:
+    sn = hashlib.md5(f"{account}-{mid}".encode("utf-8")).hexdigest()
+    return f"{base_url}/s?__biz=BENCH{account:04d}&mid={mid}&idx=1&sn={sn}"
+
+
+class FixtureState:
+    def __init__(self, verify_every: int = 0):
+        self.verify_every = verify_every
+        self.verified: set[str] = set()
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def needs_verify(self, key: str, mid: int) -> bool:
+        if not self.verify_every or mid % self.verify_every:
+            return False
+        with self.lock:
+            if key in self.verified:
+                return False
+            self.verified.add(key)
+            return True
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    state: FixtureState = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: bytes, content_type: str, headers: dict = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.state.requests += 1
+        parsed = urlsplit(self.path)
+        query = parse_qs(parsed.query)
+        if parsed.path == "/s":
+            self._article(query)
+        elif parsed.path.startswith("/img/"):
+            self._image(parsed.path[5:].rsplit(".", 1)[0])
+        elif parsed.path == "/res/style.css":
+            self._send(200, STYLE, "text/css", {"Cache-Control": "max-age=86400"})
+        elif parsed.path == "/mp/wappoc_appmsgcaptcha":
+            self._send(200, VERIFY_PAGE.encode("utf-8"), "text/html; charset=utf-8")
+        else:
+            self._send(404, b"not found", "text/plain")
+
+    def _article(self, query: dict):
+        biz = query.get("__biz", ["BENCH0000"])[0]
+        mid = int(query.get("mid", ["0"])[0])
+        if self.state.needs_verify(f"{biz}-{mid}", mid):
+            self._send(302, b"", "text/html", {"Location": f"/mp/wappoc_appmsgcaptcha?mid={mid}"})
+            return
+        paragraphs = LONG_PARAGRAPHS if mid % 4 == 0 else SHORT_PARAGRAPHS
+        body = []
+        for i in range(paragraphs):
+            body.append(f"<p>第 {i + 1} 段: " + "这是一段用于性能测试的模拟正文。" * 6 + "</p>")
+            if i % IMAGES_PER_PARAGRAPHS == 0:
+                body.append(f'<img data-src="/img/{biz}-{mid}-{i}.png?wx_fmt=png">')
+        url = f"http://{self.headers.get('Host')}{self.path}"
+        page = ARTICLE_TEMPLATE.format(url=url, title=f"测试文章 {biz} {mid}", nickname=biz, body="\n".join(body))
+        self._send(200, page.encode("utf-8"), "text/html; charset=utf-8")
+
+    def _image(self, name: str):
+        if name not in SHARED_IMAGES and zlib.crc32(name.encode("utf-8")) % SLOW_IMAGE_EVERY == 0:
+            time.sleep(SLOW_IMAGE_DELAY)
+        self._send(200, make_png(name), "image/png", {"Cache-Control": "max-age=86400"})
+
+
+def start_fixture_server(host: str = "127.0.0.1", port: int = 8765, verify_every: int = 0) -> ThreadingHTTPServer:
+    """
+    在后台线程中启动服务器, 返回的 server 调用 shutdown 停止
+    """
+    handler = type("Handler", (FixtureHandler,), {"state": FixtureState(verify_every)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模拟公众号文章的本地服务器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--verify-every", type=int, default=0, help="每多少篇文章第一次访问时返回验证页面, 0 为不返回")
+    args = parser.parse_args()
+    server = start_fixture_server(args.host, args.port, args.verify_every)
+    print(f"fixture server: http://{args.host}:{server.server_port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
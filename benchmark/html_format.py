@@ -0,0 +1,142 @@
+"""
+format_html 的一致性检查和耗时对比: 逐块替换的 format_html 必须和原来整篇逐项替换的 legacy_format_html 逐字节一致
+
+    python -m benchmark.html_format --size 4 --repeat 5
+    python -m benchmark.html_format --html 页面1.html 页面2.html
+
+--html 可以指定浏览器另存的原始页面, 不指定时使用模拟的公众号文章页面
+"""
+import time
+import tracemalloc
+import random
+import argparse
+from module.browser.html_format import format_html, iter_format_html, legacy_format_html
+
+
+PAGE_HEAD = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<link rel="stylesheet" href="//res.wx.qq.com/mmbizappmsg/zh_CN/htmledition/js/assets/appmsg.css">
+<style>
+body { -webkit-user-select:none; -moz-user-select:none; -ms-user-select:none; user-select:none; }
+.rich_media_content { -webkit-user-select: none; background: url(//mmbiz.qpic.cn/bg.png?wx_fmt=png) no-repeat; }
+</style>
+<script>
+var base = window.location.protocol + "//mp.weixin.qq.com";
+var res = location.protocol + "//res.wx.qq.com";
+</script>
+</head>
+<body>
+<div class="rich_media_content" id="js_content">
+"""
+PAGE_PARAGRAPH = (
+    '<p style="-webkit-user-select:none;">第 {i} 段, 这是一段用于测试的正文。'
+    '<a href="//mp.weixin.qq.com/s?__biz=MzA&amp;mid={i}">相关文章</a></p>\n'
+    '<img src="//mmbiz.qpic.cn/mmbiz_png/{i}/640?wx_fmt=png" style="background:url(//mmbiz.qpic.cn/{i}.gif)">\n'
+)
+PAGE_TAIL = """</div>
+<script src="//res.wx.qq.com/mmbizappmsg/zh_CN/htmledition/js/appmsg.js"></script>
+</body>
+</html>
+"""
+# 随机拼接的片段, 覆盖链接互相嵌套、缺少结束引号、跨行等情况
+FUZZ_PARTS = (
+    'src="//', 'href="//', 'url(//', '"', ')', '(', '\n', ' ', '\r', 'a', 'b.png', '中',
+    'window.location.protocol', 'location.protocol', 'window.', '-webkit-user-select: none',
+    '-webkit-user-select:none', '-moz-user-select:none', '-ms-user-select:none', 'user-select:none',
+    'user-select: none', 'src=', 'href=', '//', 'url(',
+)
+
+
+def sample_page(size_mb: float) -> str:
+    paragraphs = []
+    total, i = len(PAGE_HEAD) + len(PAGE_TAIL), 0
+    while total < size_mb * 1024 * 1024:
+        paragraph = PAGE_PARAGRAPH.format(i=i)
+        paragraphs.append(paragraph)
+        total += len(paragraph)
+        i += 1
+    return "\n  " + PAGE_HEAD + "".join(paragraphs) + PAGE_TAIL + "\n"
+
+
+def fuzz_cases(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield "".join(rng.choice(FUZZ_PARTS) for _ in range(rng.randint(0, 30)))
+
+
+def check(content: str, chunk_size: int = None) -> bool:
+    expected = legacy_format_html(content)
+    if format_html(content) != expected:
+        return False
+    if chunk_size is not None and "".join(iter_format_html(content, chunk_size)) != expected:
+        return False
+    return True
+
+
+def timeit(func, content: str, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(content)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def peak_memory(func, content: str) -> int:
+    tracemalloc.start()
+    try:
+        func(content)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def write_chunks(content: str) -> int:
+    # 模拟写文件: 逐块编码后丢弃
+    return sum(len(chunk.encode("utf-8")) for chunk in iter_format_html(content))
+
+
+def write_whole(content: str) -> int:
+    return len(legacy_format_html(content).encode("utf-8"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="format_html 一致性检查和耗时对比")
+    parser.add_argument("--html", nargs="*", default=[], help="用于检查的 html 文件")
+    parser.add_argument("--size", type=float, default=4, help="模拟页面的大小(MB)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--fuzz", type=int, default=20000, help="随机片段的检查次数")
+    args = parser.parse_args()
+
+    pages = {}
+    for path in args.html:
+        with open(path, "r", encoding="utf-8") as f:
+            pages[path] = f.read()
+    if not pages:
+        pages[f"模拟页面 {args.size}MB"] = sample_page(args.size)
+
+    failed = 0
+    for index, case in enumerate(fuzz_cases(args.fuzz)):
+        if not check(case, index % 7 + 1):
+            failed += 1
+            print(f"结果不一致: {case!r}")
+    print(f"随机片段: {args.fuzz} 个, 不一致 {failed} 个")
+
+    print(f"{'页面':<24}{'大小(MB)':>10}{'逐项替换(s)':>14}{'逐块替换(s)':>14}{'整篇写入内存(MB)':>18}{'逐块写入内存(MB)':>18}{'一致':>6}")
+    for name, content in pages.items():
+        same = check(content, 64 * 1024)
+        failed += not same
+        legacy = timeit(legacy_format_html, content, args.repeat)
+        chunked = timeit(format_html, content, args.repeat)
+        whole_peak = peak_memory(write_whole, content) / 1024 / 1024
+        chunk_peak = peak_memory(write_chunks, content) / 1024 / 1024
+        print(f"{name:<24}{len(content) / 1024 / 1024:>10.2f}{legacy:>14.4f}{chunked:>14.4f}"
+              f"{whole_peak:>18.1f}{chunk_peak:>18.1f}{'是' if same else '否':>6}")
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
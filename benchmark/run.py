@@ -0,0 +1,307 @@
+"""
+下载吞吐量测试: 向服务提交模拟文章, 统计每分钟文章数、各阶段 p50/p95、内存峰值和写入字节数
+
+默认启动一个使用临时目录和无头浏览器的服务实例, 测试结束后关闭:
+    python -m benchmark.run --articles 200 --workers 4
+
+也可以测试已经运行的服务, 需要在 config.ini 中调高 [ratelimit] 的速率:
+    python -m benchmark.run --api http://127.0.0.1:23888
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import locale
+import argparse
+import tempfile
+import subprocess
+import configparser
+import httpx
+from prometheus_client.parser import text_string_to_metric_families
+from .fixture_server import start_fixture_server, article_url
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+POLL_INTERVAL = 1
+STARTUP_TIMEOUT = 120
+
+
+def scrape(client: httpx.Client) -> dict:
+    """
+    读取 /metrics, 返回 {(指标名, 标签): 值}
+    """
+    samples = {}
+    for family in text_string_to_metric_families(client.get("/metrics").text):
+        for sample in family.samples:
+            samples[(sample.name, tuple(sorted(sample.labels.items())))] = sample.value
+    return samples
+
+
+def metric(samples: dict, name: str, **labels) -> float:
+    return samples.get((name, tuple(sorted(labels.items()))), 0)
+
+
+def histogram_quantile(q: float, buckets: list[tuple[float, float]]) -> float:
+    """
+    和 Prometheus 的 histogram_quantile 一样在桶内线性插值
+    """
+    buckets = sorted(buckets)
+    total = buckets[-1][1] if buckets else 0
+    if not total:
+        return None
+    rank = q * total
+    prev_bound, prev_count = 0, 0
+    for bound, count in buckets:
+        if count >= rank:
+            if bound == float("inf"):
+                return prev_bound
+            return prev_bound + (bound - prev_bound) * (rank - prev_count) / max(count - prev_count, 1e-9)
+        prev_bound, prev_count = bound, count
+    return prev_bound
+
+
+def stage_quantiles(before: dict, after: dict) -> dict:
+    stages: dict[str, list] = {}
+    for (name, labels), value in after.items():
+        if name != "article_stage_seconds_bucket":
+            continue
+        labels = dict(labels)
+        delta = value - before.get((name, tuple(sorted(labels.items()))), 0)
+        stages.setdefault(labels["stage"], []).append((float(labels["le"]), delta))
+    result = {}
+    for stage, buckets in sorted(stages.items()):
+        count = max(count for _, count in buckets)
+        if not count:
+            continue
+        result[stage] = {
+            "count": int(count),
+            "p50": histogram_quantile(0.5, buckets),
+            "p95": histogram_quantile(0.95, buckets),
+        }
+    return result
+
+
+def tree_rss(pid: int) -> int:
+    if psutil is None:
+        return 0
+    try:
+        process = psutil.Process(pid)
+        total = 0
+        for item in [process, *process.children(recursive=True)]:
+            try:
+                total += item.memory_info().rss
+            except psutil.Error:
+                continue
+        return total
+    except psutil.Error:
+        return 0
+
+
+def dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                continue
+    return total
+
+
+def default_chrome_path() -> str:
+    for name in ("chromium", "chromium-browser", "google-chrome", "google-chrome-stable"):
+        path = shutil.which(name)
+        if path:
+            return path
+    from playwright.sync_api import sync_playwright
+    with sync_playwright() as p:
+        return p.chromium.executable_path
+
+
+def write_config(args, work_dir: str) -> str:
+    config = configparser.ConfigParser()
+    config["base"] = {
+        "api_port": str(args.port),
+        "save_path": os.path.join(work_dir, "save"),
+        "data_dir": os.path.join(work_dir, "data"),
+        "chrome_path": args.chrome_path or default_chrome_path(),
+        "headless": "true",
+        "download_type": args.download_type,
+        "workers": str(args.workers),
+        "rebuild_index": "false",
+    }
+    # 测试的是下载速度, 速率限制放开
+    config["ratelimit"] = {"rate": "1000", "account_rate": "1000", "max_rate": "1000", "backoff": "1", "max_backoff": "5"}
+    config["logger"] = {"log_level": "WARNING"}
+    for item in args.set:
+        key, _, value = item.partition("=")
+        section, _, option = key.partition(".")
+        if not config.has_section(section):
+            config.add_section(section)
+        config[section][option] = value
+    path = os.path.join(work_dir, "config.ini")
+    # configparser 读取时使用系统默认编码
+    with open(path, "w", encoding=locale.getpreferredencoding(False)) as f:
+        config.write(f)
+    return path
+
+
+def launch_service(config_path: str, api: str) -> subprocess.Popen:
+    env = {**os.environ, "DOWNLOAD_BIZ_CONFIG": config_path}
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT_DIR, "web_app.py")], cwd=ROOT_DIR, env=env)
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"服务启动失败, 退出码 {process.returncode}")
+        try:
+            httpx.get(f"{api}/metrics", timeout=2)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError("等待服务启动超时")
+
+
+def submit(client: httpx.Client, articles: list[dict], single: int, batch: int) -> int:
+    """
+    前 single 篇逐篇提交到 /download, 其余按 batch 批量提交到 /downloads, 返回新任务数
+    """
+    created = 0
+    for article in articles[:single]:
+        created += client.post("/download", json=article).json().get("task_id") is not None
+    rest = articles[single:]
+    for start in range(0, len(rest), batch):
+        created += len(client.post("/downloads", json=rest[start:start + batch]).json()["task_ids"])
+    return created
+
+
+def make_articles(fixture_url: str, count: int, accounts: int, run_id: int) -> list[dict]:
+    articles = []
+    for i in range(count):
+        account = i % accounts
+        # 每次运行使用不同的 mid, 不会被已下载的文章跳过
+        mid = run_id * 100000 + i
+        articles.append({
+            "url": article_url(fixture_url, account, mid),
+            "title": f"bench-{account}-{mid}",
+            "pub_time": "2024-01-01 08:00:00",
+            "nickname": f"bench{account:02d}",
+        })
+    return articles
+
+
+def run(args) -> dict:
+    fixture = start_fixture_server(port=args.fixture_port, verify_every=args.verify_every)
+    fixture_url = f"http://127.0.0.1:{fixture.server_port}"
+    work_dir = process = None
+    api = args.api
+    try:
+        if api is None:
+            api = f"http://127.0.0.1:{args.port}"
+            work_dir = tempfile.mkdtemp(prefix="biz_bench_")
+            process = launch_service(write_config(args, work_dir), api)
+        with httpx.Client(base_url=api, timeout=60) as client:
+            before = scrape(client)
+            articles = make_articles(fixture_url, args.articles, args.accounts, int(time.time()) % 10000)
+            started = time.monotonic()
+            created = submit(client, articles, args.single, args.batch)
+            peak_rss = peak_browser_rss = 0
+            while True:
+                time.sleep(POLL_INTERVAL)
+                samples = scrape(client)
+                peak_browser_rss = max(peak_browser_rss, metric(samples, "browser_rss_bytes"))
+                if process is not None:
+                    peak_rss = max(peak_rss, tree_rss(process.pid))
+                unfinished = sum(
+                    metric(samples, "task_queue_depth", queue=queue, state=state)
+                    for queue in ("download", "render") for state in ("pending", "running")
+                )
+                if not unfinished or time.monotonic() - started > args.timeout:
+                    break
+            elapsed = time.monotonic() - started
+            after = scrape(client)
+    except BaseException:
+        if work_dir and not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+    finally:
+        fixture.shutdown()
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=60)
+    results = {
+        labels[0][1]: int(value - before.get((name, labels), 0))
+        for (name, labels), value in after.items()
+        if name == "article_tasks_total" and value - before.get((name, labels), 0)
+    }
+    bytes_written = {
+        labels[0][1]: int(value - before.get((name, labels), 0))
+        for (name, labels), value in after.items()
+        if name == "article_bytes_written_total"
+    }
+    report = {
+        "articles": args.articles,
+        "created": created,
+        "elapsed": round(elapsed, 2),
+        "timed_out": bool(unfinished),
+        "articles_per_min": round(results.get("done", 0) / elapsed * 60, 2),
+        "results": results,
+        "stages": stage_quantiles(before, after),
+        "peak_rss": peak_rss or None,
+        "peak_browser_rss": peak_browser_rss or None,
+        "bytes_written": bytes_written,
+        "save_path_bytes": dir_size(os.path.join(work_dir, "save")) if work_dir else None,
+        "browser_restarts": int(metric(after, "browser_restarts_total") - metric(before, "browser_restarts_total")),
+    }
+    if work_dir and not args.keep:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+def print_report(report: dict):
+    mb = lambda value: f"{value / 1024 / 1024:.1f} MB" if value else "-"
+    print(f"文章数: {report['articles']}  新任务: {report['created']}  耗时: {report['elapsed']}s"
+          f"{'  (超时)' if report['timed_out'] else ''}")
+    print(f"吞吐量: {report['articles_per_min']} 篇/分钟  结果: {report['results']}  浏览器重启: {report['browser_restarts']}")
+    print(f"内存峰值: 服务进程树 {mb(report['peak_rss'])}, 浏览器 {mb(report['peak_browser_rss'])}")
+    print(f"写入: {', '.join(f'{fmt} {mb(size)}' for fmt, size in report['bytes_written'].items()) or '-'}"
+          f"  保存目录: {mb(report['save_path_bytes'])}")
+    print(f"{'阶段':<16}{'次数':>8}{'p50(s)':>10}{'p95(s)':>10}")
+    for stage, item in report["stages"].items():
+        print(f"{stage:<16}{item['count']:>8}{item['p50']:>10.3f}{item['p95']:>10.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="文章下载吞吐量测试")
+    parser.add_argument("--api", help="已运行服务的地址, 不设置时启动一个临时服务")
+    parser.add_argument("--port", type=int, default=23999, help="临时服务的端口")
+    parser.add_argument("--fixture-port", type=int, default=0, help="模拟文章服务器端口, 0 为随机")
+    parser.add_argument("--articles", type=int, default=100)
+    parser.add_argument("--accounts", type=int, default=4, help="文章分布在多少个公众号")
+    parser.add_argument("--single", type=int, default=10, help="逐篇提交到 /download 的文章数, 其余批量提交")
+    parser.add_argument("--batch", type=int, default=50, help="每次提交到 /downloads 的文章数")
+    parser.add_argument("--verify-every", type=int, default=0, help="每多少篇文章返回一次验证页面")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--download-type", default="pdf,mhtml,html")
+    parser.add_argument("--chrome-path", help="浏览器路径, 默认查找系统 chromium 或 playwright 自带的浏览器")
+    parser.add_argument("--set", action="append", default=[], metavar="SECTION.KEY=VALUE",
+                        help="覆盖临时服务的配置, 例如 --set base.pdf_mode=deferred")
+    parser.add_argument("--timeout", type=float, default=1800)
+    parser.add_argument("--json", help="把结果写入 JSON 文件, 方便多次运行对比")
+    parser.add_argument("--keep", action="store_true", help="保留临时服务的保存目录")
+    args = parser.parse_args()
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,72 +1,244 @@
-import asyncio
-import json
-import os
-from contextlib import asynccontextmanager
-from ..browser.launch import ChromeManager
-from ..browser.manager import PlaywrightHtmlManager
-from ..settings import ROOT_DIR
-
-
-async def download_task_handler(app, task_event):
-    task_queue = app.state.task_queue
-    chrome_manager = app.state.chrome_manager
-    manager = PlaywrightHtmlManager(chrome_manager)
-    while not task_event.is_set():
-        task = await task_queue.get()
-        if task is None: 
-            await asyncio.sleep(1)  
-            continue
-        try:
-            await manager.browser_get(task)
-        except Exception as e:
-            print(f"处理任务时发生错误: {e}")
-        await asyncio.sleep(5)
-
-async def save_unfinished_tasks(task_queue):
-    tasks = []
-    while not task_queue.empty():
-        task = await task_queue.get()
-        if task is not None:
-            tasks.append(task)
-    if tasks:
-        path = os.path.join(ROOT_DIR, "unfinished_tasks.json")
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(tasks, f, ensure_ascii=False, indent=2)
-
-async def load_unfinished_tasks(task_queue):
-    unfinished_path = os.path.join(ROOT_DIR, "unfinished_tasks.json")
-    if os.path.exists(unfinished_path):
-        with open(unfinished_path, "r", encoding="utf-8") as f:
-            try:
-                unfinished_tasks = json.load(f)
-                for task in unfinished_tasks:
-                    await task_queue.put(task)
-            except Exception as e:
-                print(f"恢复未完成任务时发生错误: {e}")
-        try:
-            os.remove(unfinished_path)  
-        except Exception as e:
-            print(f"删除未完成任务文件时发生错误: {e}")
-
-def get_lifespan(settings):
-    @asynccontextmanager
-    async def lifespan(app):
-        task_queue = asyncio.Queue()
-        task_event = asyncio.Event()
-        # 从文件恢复未完成的任务到队列
-        await load_unfinished_tasks(task_queue)
-        app.state.task_queue = task_queue
-        app.state.settings = settings["base"]
-        app.state.chrome_manager = ChromeManager(app, settings)
-        await app.state.chrome_manager.__aenter__()
-        if not settings["base"].get("save_path"):
-            raise ValueError("Save path is not configured in settings.")
-        app.state.save_path = settings["base"]["save_path"]
-        asyncio.create_task(download_task_handler(app, task_event))
-        yield {"task_queue": task_queue}
-        await app.state.chrome_manager.__aexit__(None, None, None)
-        task_event.set()
-        # 保存未完成的任务
-        await save_unfinished_tasks(task_queue)
-        
-    return lifespan
\ No newline at end of file
+import asyncio
+import json
+import os
+from contextlib import asynccontextmanager
+from loguru import logger
+from ..browser.launch import ChromeManager
+from ..browser.manager import PlaywrightHtmlManager
+from ..browser.blocked import BlockedPageError
+from ..browser.fetcher import HttpArticleFetcher
+from ..browser.renderer import PdfRenderer, pdf_print_options
+from ..scheduler.ratelimit import AdaptiveRateLimiter
+from ..storage.task_queue import SqliteTaskQueue
+from ..storage.article_index import ArticleIndex
+from ..storage.image_store import ImageStore
+from ..storage.output import create_output
+from ..storage.search_index import open_search_index
+from ..settings import ROOT_DIR, DATA_DIR, WORKER_DRAIN_TIMEOUT
+from ..tools.metrics import TaskTrace, TASKS_IN_FLIGHT, start_trace, stage_timer
+
+
+async def finish_task(task_queue: SqliteTaskQueue, task: dict, save, trace: TaskTrace, worker_id=0):
+    task_id = task["task_id"]
+    try:
+        if save is not None:
+            await save
+    except Exception as e:
+        logger.exception(f"[worker-{worker_id}] 任务 {task_id} 保存文件失败: {e}")
+        await task_queue.fail(task_id, repr(e))
+        trace.finish("save_failed")
+    else:
+        await task_queue.done(task_id)
+        trace.finish("done" if save is not None else "skipped")
+    finally:
+        TASKS_IN_FLIGHT.dec()
+
+async def wait_rate_limit(task_queue: SqliteTaskQueue, rate_limiter: AdaptiveRateLimiter, task: dict):
+    """
+    等待限速令牌; 遇到验证页面后的暂停可能比任务租约更长, 等待期间定时延长该任务的租约
+    """
+    waiting = asyncio.ensure_future(rate_limiter.acquire(task["url"], task.get("nickname")))
+    try:
+        while not (await asyncio.wait({waiting}, timeout=task_queue.lease_seconds / 3))[0]:
+            await task_queue.touch([task["task_id"]])
+    finally:
+        waiting.cancel()
+    waiting.result()
+
+async def download_task_handler(app, task_event, worker_id=0):
+    task_queue: SqliteTaskQueue = app.state.task_queue
+    chrome_manager = app.state.chrome_manager
+    rate_limiter: AdaptiveRateLimiter = app.state.rate_limiter
+    manager = PlaywrightHtmlManager(chrome_manager)
+    # 上一篇文章的写文件任务, 与下一篇文章的页面加载同时进行
+    saving = None
+    try:
+        while not task_event.is_set():
+            task = await task_queue.get(timeout=1)
+            if task is None: 
+                continue
+            task_id = task["task_id"]
+            trace = start_trace(task, worker_id, app.state.trace_tasks)
+            TASKS_IN_FLIGHT.inc()
+            try:
+                with stage_timer("ratelimit_wait"):
+                    await wait_rate_limit(task_queue, rate_limiter, task)
+                save = await manager.browser_get(task)
+            except asyncio.CancelledError:
+                # 关闭时被取消, 将正在处理的任务放回队列, 下次启动继续下载
+                await task_queue.requeue(task_id)
+                TASKS_IN_FLIGHT.dec()
+                raise
+            except BlockedPageError as e:
+                delay = rate_limiter.blocked(task["url"], task.get("nickname"))
+                # 计入重试次数, 一直遇到验证页面的文章超过最大次数后标记失败, 不会无限重试
+                retry = await task_queue.fail(task_id, repr(e))
+                logger.warning(f"[worker-{worker_id}] 任务 {task_id} 第 {task['attempts']} 次遇到微信验证页面, "
+                               f"暂停该域名下所有公众号的下载 {delay:.0f}s, {'之后重新下载' if retry else '不再重试'}")
+                trace.finish("blocked" if retry else "failed")
+                TASKS_IN_FLIGHT.dec()
+            except Exception as e:
+                retry = await task_queue.fail(task_id, repr(e))
+                logger.warning(f"[worker-{worker_id}] 任务 {task_id} 第 {task['attempts']} 次处理失败, {'稍后重试' if retry else '不再重试'}: {e}")
+                trace.finish("retry" if retry else "failed")
+                TASKS_IN_FLIGHT.dec()
+            else:
+                rate_limiter.success(task["url"], task.get("nickname"))
+                if saving is not None:
+                    await saving
+                saving = asyncio.create_task(finish_task(task_queue, task, save, trace, worker_id))
+    finally:
+        if saving is not None:
+            await asyncio.shield(saving)
+
+async def stop_workers(task_event, workers):
+    task_event.set()
+    _, pending = await asyncio.wait(workers, timeout=WORKER_DRAIN_TIMEOUT)
+    for worker in pending:
+        worker.cancel()
+    if pending:
+        logger.info(f"{len(pending)} 个下载任务未在 {WORKER_DRAIN_TIMEOUT}s 内完成, 已取消")
+        await asyncio.gather(*pending, return_exceptions=True)
+
+async def load_unfinished_tasks(task_queue: SqliteTaskQueue):
+    # 旧版本关闭时把队列保存在 unfinished_tasks.json, 迁移到数据库后删除
+    unfinished_path = os.path.join(ROOT_DIR, "unfinished_tasks.json")
+    if os.path.exists(unfinished_path):
+        with open(unfinished_path, "r", encoding="utf-8") as f:
+            try:
+                unfinished_tasks = json.load(f)
+                await task_queue.put_many(unfinished_tasks)
+                logger.info(f"已将 {len(unfinished_tasks)} 个未完成任务迁移到任务队列")
+            except Exception as e:
+                print(f"恢复未完成任务时发生错误: {e}")
+        try:
+            os.remove(unfinished_path)  
+        except Exception as e:
+            print(f"删除未完成任务文件时发生错误: {e}")
+
+def open_task_queue(base: dict, name: str) -> SqliteTaskQueue:
+    data_dir = base.get("data_dir") or DATA_DIR
+    return SqliteTaskQueue(
+        os.path.join(data_dir, name),
+        lease_seconds=float(base.get("task_lease") or 600),
+        max_attempts=int(base.get("max_attempts") or 3),
+    )
+
+async def open_stores(app, settings, primary: bool = True):
+    """
+    打开任务队列和文章索引, primary 为 API 进程, 负责恢复上次未完成的任务和重建索引
+    """
+    base = settings["base"]
+    if not base.get("save_path"):
+        raise ValueError("Save path is not configured in settings.")
+    task_queue = open_task_queue(base, "tasks.db")
+    await task_queue.open()
+    if primary:
+        # 上次异常退出时正在处理的任务重新放回队列
+        recovered = await task_queue.recover()
+        if recovered:
+            logger.info(f"已恢复 {recovered} 个上次未完成的下载任务")
+        await load_unfinished_tasks(task_queue)
+    article_index = ArticleIndex(os.path.join(base.get("data_dir") or DATA_DIR, "articles.db"))
+    await article_index.open()
+    await article_index.load()
+    if primary and (not len(article_index) or base.get("rebuild_index", "false") == "true"):
+        count = await article_index.rebuild(base["save_path"])
+        logger.info(f"已从保存目录重建文章索引, 共 {count} 篇文章")
+    render_queue = None
+    if base.get("pdf_mode", "inline") == "deferred":
+        render_queue = open_task_queue(base, "render.db")
+        # 打印任务可能由单独运行的打印 worker 处理, 启动时不重置 running 的任务, 依靠租约过期重新领取
+        await render_queue.open()
+    search_index = open_search_index(settings)
+    if search_index is not None:
+        await search_index.open()
+    app.state.task_queue = task_queue
+    app.state.article_index = article_index
+    app.state.render_queue = render_queue
+    app.state.search_index = search_index
+    app.state.settings = base
+    app.state.save_path = base["save_path"]
+    app.state.trace_tasks = settings.get("logger", {}).get("trace", "false") == "true"
+
+async def close_stores(app):
+    await app.state.task_queue.close()
+    if app.state.render_queue is not None:
+        await app.state.render_queue.close()
+    await app.state.article_index.close()
+    if app.state.search_index is not None:
+        await app.state.search_index.close()
+
+async def start_downloader(app, settings, share: int = 1, name: str = "", renderer: bool = True):
+    """
+    启动浏览器、下载 worker 和打印 worker; 多进程下载时每个进程各启动一份, share 为进程数
+    """
+    base = settings["base"]
+    app.state.rate_limiter = AdaptiveRateLimiter.from_settings(settings, share)
+    app.state.http_fetcher = HttpArticleFetcher.from_settings(settings)
+    app.state.pdf_options = pdf_print_options(settings)
+    app.state.output = create_output(settings)
+    app.state.image_store = ImageStore.from_settings(settings, app.state.output)
+    app.state.chrome_manager = ChromeManager(app, settings)
+    await app.state.chrome_manager.__aenter__()
+    app.state.task_event = asyncio.Event()
+    worker_count = max(int(base.get("workers") or 1), 1)
+    app.state.workers = [
+        asyncio.create_task(download_task_handler(app, app.state.task_event, f"{name}{i}"))
+        for i in range(worker_count)
+    ]
+    # 处理时间超过租约的任务定时续约, 不会被其他 worker 重复领取
+    app.state.heartbeats = [asyncio.create_task(app.state.task_queue.heartbeat())]
+    logger.info(f"已启动 {worker_count} 个下载 worker")
+    app.state.renderer = None
+    render_queue = app.state.render_queue
+    # renderers = 0 时不在本进程打印, 由 python -m module.browser.renderer 单独运行
+    if renderer and render_queue is not None and int(settings.get("pdf", {}).get("renderers") or 1) > 0:
+        app.state.renderer = PdfRenderer.from_settings(settings, render_queue, app.state.article_index, app.state.output)
+        await app.state.renderer.start()
+        app.state.heartbeats.append(asyncio.create_task(render_queue.heartbeat()))
+
+async def stop_downloader(app):
+    await stop_workers(app.state.task_event, app.state.workers)
+    if app.state.renderer is not None:
+        await app.state.renderer.close()
+    for heartbeat in app.state.heartbeats:
+        heartbeat.cancel()
+    await asyncio.gather(*app.state.heartbeats, return_exceptions=True)
+    await app.state.chrome_manager.__aexit__(None, None, None)
+    if app.state.http_fetcher is not None:
+        await app.state.http_fetcher.close()
+    await app.state.output.close()
+
+def get_lifespan(settings):
+    @asynccontextmanager
+    async def lifespan(app):
+        await open_stores(app, settings)
+        # 其他进程保存的文章定时同步到本进程的索引, 入队时不会把已下载的文章当作未下载
+        index_watcher = asyncio.create_task(app.state.article_index.watch())
+        processes = int(settings["base"].get("processes") or 0)
+        if processes > 1:
+            from .processes import WorkerProcessPool
+            # 下载在子进程中进行, 本进程只处理接口请求, 任务事件从数据库同步
+            # 限速器在各下载进程中, 本进程没有可查询的限速状态
+            app.state.rate_limiter = None
+            pool = WorkerProcessPool(settings, processes)
+            pool.start()
+            watchers = [
+                asyncio.create_task(app.state.task_queue.watch()),
+                asyncio.create_task(pool.supervise()),
+            ]
+            yield {"task_queue": app.state.task_queue}
+            for watcher in watchers:
+                watcher.cancel()
+            await asyncio.gather(*watchers, return_exceptions=True)
+            await asyncio.to_thread(pool.stop)
+        else:
+            await start_downloader(app, settings)
+            yield {"task_queue": app.state.task_queue}
+            await stop_downloader(app)
+        index_watcher.cancel()
+        await asyncio.gather(index_watcher, return_exceptions=True)
+        await close_stores(app)
+        
+    return lifespan
@@ -0,0 +1,118 @@
+import os
+import time
+import signal
+import asyncio
+import multiprocessing
+from types import SimpleNamespace
+from loguru import logger
+from prometheus_client import multiprocess
+from .lifespan import open_stores, close_stores, start_downloader, stop_downloader
+from ..settings import WORKER_DRAIN_TIMEOUT
+from ..tools import setup_logger
+
+
+# 检查下载进程是否异常退出的间隔(秒)
+SUPERVISE_INTERVAL = 5
+# 下载进程启动后这么久(秒)内退出视为启动失败, 连续失败 MAX_FAST_FAILURES 次后不再重启
+FAST_FAILURE_WINDOW = 60
+MAX_FAST_FAILURES = 3
+# 等待下载进程退出时, 在 WORKER_DRAIN_TIMEOUT 之外额外留给关闭浏览器的时间(秒)
+PROCESS_EXIT_MARGIN = 30
+
+
+def worker_process_settings(settings: dict, index: int) -> dict:
+    base = settings["base"]
+    if not base.get("user_data_dir"):
+        return settings
+    # 同一个用户数据目录不能同时被两个浏览器使用, 每个进程使用自己的目录
+    return {**settings, "base": {**base, "user_data_dir": f"{base['user_data_dir']}-{index}"}}
+
+
+async def run_worker_process(index: int, settings: dict, processes: int, stop_event):
+    app = SimpleNamespace(state=SimpleNamespace())
+    await open_stores(app, settings, primary=False)
+    # 延后打印的 PDF 只在第一个进程中处理
+    await start_downloader(app, settings, processes, name=f"{index}-", renderer=index == 0)
+    # 其他进程保存的文章同步到本进程的索引, 避免重复下载
+    watcher = asyncio.create_task(app.state.article_index.watch())
+    logger.info(f"下载进程 {index} 已启动")
+    try:
+        while not stop_event.is_set():
+            await asyncio.sleep(1)
+    finally:
+        watcher.cancel()
+        await asyncio.gather(watcher, return_exceptions=True)
+        await stop_downloader(app)
+        await close_stores(app)
+        logger.info(f"下载进程 {index} 已退出")
+
+
+def worker_process_main(index: int, settings: dict, processes: int, stop_event):
+    # Ctrl+C 由 API 进程处理, 通过 stop_event 通知下载进程处理完当前任务后退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setup_logger(f"worker-{index}.log", settings.get("logger", {}).get("log_level", "INFO"))
+    asyncio.run(run_worker_process(index, worker_process_settings(settings, index), processes, stop_event))
+
+
+def mark_process_dead(pid: int):
+    # 清理已退出进程的 live 类型指标, 未开启多进程指标时跳过
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(pid)
+
+
+class WorkerProcessPool:
+    """
+    多进程下载, 每个进程有自己的浏览器和事件循环, 从同一个任务数据库中按租约领取任务
+    """
+    def __init__(self, settings: dict, processes: int):
+        self.settings = settings
+        self.processes = processes
+        self._context = multiprocessing.get_context("spawn")
+        self._stop_event = self._context.Event()
+        self._workers: list[multiprocessing.Process] = [None] * processes
+        self._started = [0.0] * processes
+        self._failures = [0] * processes
+
+    def _spawn(self, index: int):
+        process = self._context.Process(
+            target=worker_process_main,
+            args=(index, self.settings, self.processes, self._stop_event),
+            name=f"download-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        self._workers[index] = process
+        self._started[index] = time.monotonic()
+
+    def start(self):
+        for index in range(self.processes):
+            self._spawn(index)
+        logger.info(f"已启动 {self.processes} 个下载进程")
+
+    async def supervise(self):
+        """
+        下载进程异常退出时重新启动, 它领取的任务在租约过期后由其他进程继续处理
+        """
+        while True:
+            await asyncio.sleep(SUPERVISE_INTERVAL)
+            for index, process in enumerate(self._workers):
+                if process.is_alive() or self._stop_event.is_set() or self._failures[index] > MAX_FAST_FAILURES:
+                    continue
+                mark_process_dead(process.pid)
+                fast = time.monotonic() - self._started[index] < FAST_FAILURE_WINDOW
+                self._failures[index] = self._failures[index] + 1 if fast else 1
+                if self._failures[index] > MAX_FAST_FAILURES:
+                    logger.error(f"下载进程 {index} 重启 {MAX_FAST_FAILURES} 次后仍很快退出, 不再重启, 请检查日志 worker-{index}.log")
+                    continue
+                logger.error(f"下载进程 {index} 异常退出, 退出码 {process.exitcode}, 重新启动")
+                self._spawn(index)
+
+    def stop(self):
+        self._stop_event.set()
+        for process in self._workers:
+            process.join(WORKER_DRAIN_TIMEOUT + PROCESS_EXIT_MARGIN)
+            if process.is_alive():
+                logger.warning(f"下载进程 {process.name} 未能按时退出, 强制结束")
+                process.terminate()
+                process.join()
+            mark_process_dead(process.pid)
@@ -1,34 +1,206 @@
-from loguru import logger
-from fastapi import APIRouter, Request, Response
-from pydantic import BaseModel
-
-
-api_router = APIRouter()
-
-class DownloadPostData(BaseModel):
-    url: str
-    title: str
-    pub_time: str
-    copyright_stat: int = 0
-    nickname: str = None
-
-
-@api_router.post("/download")
-async def download(options: DownloadPostData, request: Request):
-    queue = request.app.state.task_queue
-    task_dict = {
-        "url": options.url,
-        "title": options.title,
-        "pub_time": options.pub_time,
-        "copyright_stat": options.copyright_stat,
-        "nickname": options.nickname
-    }
-    await queue.put(task_dict)
-    logger.info(f"已将下载任务添加到队列: {task_dict}")
-    return Response(status_code=200, content="任务已添加到下载队列")
-
-@api_router.post("/downloads")
-async def downloads(options: list[DownloadPostData], request: Request):
-    for option in options:
-        await download(option, request)
-    return Response(status_code=200, content="任务已添加到下载队列")
\ No newline at end of file
+import json
+import time
+import uuid
+import sqlite3
+import asyncio
+from loguru import logger
+from fastapi import APIRouter, Request, HTTPException, Query
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST
+from pydantic import BaseModel, ValidationError
+from ..storage.article_index import normalize_article_url
+from ..storage.task_queue import TASK_STATES
+from ..tools import parse_download_types
+from ..tools.metrics import QUEUE_DEPTH, export_metrics
+
+
+api_router = APIRouter()
+
+# NDJSON 批量导入时每批校验和写入的任务数量
+NDJSON_BATCH_SIZE = 1000
+# 返回给调用方的错误行数上限
+NDJSON_MAX_ERRORS = 20
+
+class DownloadPostData(BaseModel):
+    url: str
+    title: str
+    pub_time: str
+    copyright_stat: int = 0
+    nickname: str = None
+    # 优先级越大越先下载, 实时监听到的新文章可以设置较高的优先级
+    priority: int = 0
+
+
+def to_task_dict(options: DownloadPostData) -> dict:
+    return {
+        "url": options.url,
+        "title": options.title,
+        "pub_time": options.pub_time,
+        "copyright_stat": options.copyright_stat,
+        "nickname": options.nickname,
+        "priority": options.priority
+    }
+
+
+async def enqueue_tasks(app, options: list[DownloadPostData], job_id: str = None) -> tuple[list[int], int]:
+    """
+    已下载或已在队列中的文章直接跳过, 返回新任务 ID 和重复数量
+    """
+    index = app.state.article_index
+    download_types = parse_download_types(app.state.settings)
+    tasks, dedupe_keys, priorities, accounts = [], [], [], []
+    for option in options:
+        if index.is_downloaded(option.url, download_types):
+            continue
+        tasks.append(to_task_dict(option))
+        dedupe_keys.append(normalize_article_url(option.url))
+        priorities.append(option.priority)
+        accounts.append(option.nickname)
+    # 一个事务批量写入, 避免上万个任务逐条提交
+    ids = await app.state.task_queue.put_many(tasks, dedupe_keys, priorities, accounts, job_id)
+    task_ids = [task_id for task_id in ids if task_id is not None]
+    return task_ids, len(options) - len(task_ids)
+
+
+@api_router.post("/download")
+async def download(options: DownloadPostData, request: Request):
+    task_ids, _ = await enqueue_tasks(request.app, [options])
+    if not task_ids:
+        logger.info(f"文章已下载或已在队列中, 跳过: {options.url}")
+        return JSONResponse({"detail": "文章已下载或已在下载队列中", "task_id": None})
+    logger.info(f"已将下载任务添加到队列: {to_task_dict(options)}")
+    return JSONResponse({"detail": "任务已添加到下载队列", "task_id": task_ids[0]})
+
+@api_router.post("/downloads")
+async def downloads(options: list[DownloadPostData], request: Request):
+    task_ids, duplicates = await enqueue_tasks(request.app, options)
+    logger.info(f"已将 {len(task_ids)} 个下载任务添加到队列, 跳过 {duplicates} 个重复任务")
+    return JSONResponse({"detail": "任务已添加到下载队列", "task_ids": task_ids, "duplicates": duplicates})
+
+@api_router.post("/downloads/ndjson")
+async def downloads_ndjson(request: Request):
+    """
+    每行一个任务的 NDJSON, 边接收边校验, 每批一个事务写入队列, 适合上万篇的历史文章
+    """
+    job_id = uuid.uuid4().hex
+    accepted = duplicates = rejected = 0
+    errors = []
+    batch: list[DownloadPostData] = []
+    buffer = b""
+    line_no = 0
+
+    async def flush():
+        nonlocal accepted, duplicates
+        task_ids, skipped = await enqueue_tasks(request.app, batch, job_id)
+        accepted += len(task_ids)
+        duplicates += skipped
+        batch.clear()
+
+    def parse(line: bytes):
+        nonlocal rejected
+        if not line.strip():
+            return
+        try:
+            batch.append(DownloadPostData.model_validate_json(line))
+        except ValidationError as e:
+            rejected += 1
+            if len(errors) < NDJSON_MAX_ERRORS:
+                errors.append({"line": line_no, "error": e.errors(include_url=False)[0]["msg"]})
+
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            line_no += 1
+            parse(line)
+            if len(batch) >= NDJSON_BATCH_SIZE:
+                await flush()
+    line_no += 1
+    parse(buffer)
+    if batch:
+        await flush()
+    logger.info(f"批量导入任务 {job_id}: 添加 {accepted} 个, 重复 {duplicates} 个, 格式错误 {rejected} 个")
+    return {"job_id": job_id, "accepted": accepted, "duplicates": duplicates, "rejected": rejected, "errors": errors}
+
+@api_router.get("/ratelimit")
+async def ratelimit(request: Request):
+    rate_limiter = request.app.state.rate_limiter
+    if rate_limiter is None:
+        raise HTTPException(status_code=404, detail="多进程下载时每个下载进程各自限速, 请在 worker-<i>.log 中查看限速和退避情况")
+    return rate_limiter.snapshot()
+
+@api_router.get("/search")
+async def search(request: Request, q: str, nickname: str = None, date_from: str = Query(None, alias="from"),
+                 date_to: str = Query(None, alias="to"), limit: int = 20, offset: int = 0):
+    """
+    全文搜索已下载的文章, from/to 为发布时间范围, 格式 2024-01-01 或 2024-01-01 08:00:00
+    """
+    search_index = request.app.state.search_index
+    if search_index is None:
+        raise HTTPException(status_code=404, detail="未开启全文搜索, 请在配置文件的 [search] 中设置 enabled = true")
+    started = time.perf_counter()
+    try:
+        result = await search_index.search(q, nickname, date_from, date_to, min(limit, 100), offset)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except sqlite3.OperationalError as e:
+        raise HTTPException(status_code=400, detail=f"搜索词无效: {e}")
+    result["took_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    return result
+
+@api_router.get("/metrics")
+async def metrics(request: Request):
+    """
+    Prometheus 格式的监控指标, 队列长度在抓取时从数据库读取, 多进程下载时汇总所有进程的指标
+    """
+    queues = {"download": request.app.state.task_queue, "render": request.app.state.render_queue}
+    for name, queue in queues.items():
+        if queue is None:
+            continue
+        for state, count in (await queue.counts()).items():
+            QUEUE_DEPTH.labels(name, state).set(count)
+    return Response(export_metrics(), media_type=CONTENT_TYPE_LATEST)
+
+@api_router.get("/tasks")
+async def list_tasks(request: Request, state: str = None, job_id: str = None, limit: int = 100, offset: int = 0):
+    if state and state not in TASK_STATES:
+        raise HTTPException(status_code=400, detail=f"state 只能是: {', '.join(TASK_STATES)}")
+    return await request.app.state.task_queue.list_tasks(state, job_id, min(limit, 1000), offset)
+
+@api_router.get("/tasks/events")
+async def task_events(request: Request):
+    """
+    以 SSE 推送任务完成、失败和取消事件
+    """
+    events = request.app.state.task_queue.events
+
+    async def stream():
+        queue = events.subscribe()
+        try:
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                yield f"event: {event['state']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+        finally:
+            events.unsubscribe(queue)
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+@api_router.get("/tasks/{task_id}")
+async def get_task(task_id: int, request: Request):
+    task = await request.app.state.task_queue.get_task(task_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return task
+
+@api_router.delete("/tasks/{task_id}")
+async def cancel_task(task_id: int, request: Request):
+    queue = request.app.state.task_queue
+    if await queue.cancel(task_id):
+        return {"detail": "任务已取消", "task_id": task_id}
+    if await queue.get_task(task_id) is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    raise HTTPException(status_code=409, detail="只能取消还未开始的任务")
@@ -0,0 +1,210 @@
+import os
+import time
+import hashlib
+import sqlite3
+import fnmatch
+import aiofiles
+import aiofiles.os
+import aiofiles.ospath
+import playwright
+from urllib.parse import urlsplit
+from loguru import logger
+from playwright.async_api import Route
+from ..storage.base import SqliteStore, transaction
+from ..settings import DATA_DIR
+
+
+DEFAULT_CACHE_HOSTS = "mmbiz.qpic.cn,mmbiz.qlogo.cn,wx.qlogo.cn,res.wx.qq.com"
+DEFAULT_CACHE_TYPES = "image,font,stylesheet,script"
+# 统计、广告和视频请求与 PDF/MHTML 内容无关, 直接拦截
+DEFAULT_BLOCK_URLS = ",".join([
+    "*://badjs.weixinbridge.com/*",
+    "*://mp.weixin.qq.com/mp/jsmonitor*",
+    "*://mp.weixin.qq.com/mp/jsreport*",
+    "*://mp.weixin.qq.com/mp/appmsgreport*",
+    "*://mp.weixin.qq.com/mp/getappmsgad*",
+    "*://mp.weixin.qq.com/mp/videoplayer*",
+    "*://mpvideo.qpic.cn/*",
+    "*://*.google-analytics.com/*",
+])
+DEFAULT_BLOCK_TYPES = "media"
+
+
+def split_setting(value: str) -> list[str]:
+    return [item.strip() for item in (value or "").split(",") if item.strip()]
+
+
+class AssetCache(SqliteStore):
+    """
+    图片、字体和脚本的磁盘缓存, 文件按内容哈希保存, 超过容量后按最近使用时间淘汰
+    """
+    schema = """
+    CREATE TABLE IF NOT EXISTS assets (
+        url TEXT PRIMARY KEY,
+        digest TEXT NOT NULL,
+        content_type TEXT,
+        size INTEGER NOT NULL,
+        last_used REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_assets_last_used ON assets(last_used);
+    CREATE INDEX IF NOT EXISTS idx_assets_digest ON assets(digest);
+    """
+
+    def __init__(self, cache_dir: str, max_size: int):
+        super().__init__(os.path.join(cache_dir, "assets.db"))
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._total_size = 0
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def _lookup(self, conn: sqlite3.Connection, url: str) -> sqlite3.Row:
+        row = conn.execute("SELECT digest, content_type FROM assets WHERE url = ?", (url,)).fetchone()
+        if row is not None:
+            conn.execute("UPDATE assets SET last_used = ? WHERE url = ?", (time.time(), url))
+        return row
+
+    def _insert(self, conn: sqlite3.Connection, url: str, digest: str, content_type: str, size: int) -> list[str]:
+        with transaction(conn):
+            old = conn.execute("SELECT size FROM assets WHERE url = ?", (url,)).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO assets (url, digest, content_type, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                (url, digest, content_type, size, time.time())
+            )
+        self._total_size += size - (old["size"] if old else 0)
+        return self._evict(conn) if self._total_size > self.max_size else []
+
+    def _evict(self, conn: sqlite3.Connection) -> list[str]:
+        # 淘汰到容量的 90%, 避免每次写入都触发淘汰
+        target = self.max_size * 0.9
+        removed = []
+        with transaction(conn):
+            for row in conn.execute("SELECT url, digest, size FROM assets ORDER BY last_used").fetchall():
+                if self._total_size <= target:
+                    break
+                conn.execute("DELETE FROM assets WHERE url = ?", (row["url"],))
+                self._total_size -= row["size"]
+                if not conn.execute("SELECT 1 FROM assets WHERE digest = ? LIMIT 1", (row["digest"],)).fetchone():
+                    removed.append(row["digest"])
+        return removed
+
+    def _load_size(self, conn: sqlite3.Connection):
+        self._total_size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM assets").fetchone()[0]
+
+    async def open(self):
+        await super().open()
+        await self._run(self._load_size)
+        return self
+
+    async def get(self, url: str) -> tuple[bytes, str]:
+        row = await self._run(self._lookup, url)
+        if row is None:
+            return None
+        try:
+            async with aiofiles.open(self.blob_path(row["digest"]), "rb") as f:
+                return await f.read(), row["content_type"]
+        except OSError:
+            return None
+
+    async def put(self, url: str, body: bytes, content_type: str):
+        digest = hashlib.sha256(body).hexdigest()
+        path = self.blob_path(digest)
+        if not await aiofiles.ospath.exists(path):
+            await aiofiles.os.makedirs(os.path.dirname(path), exist_ok=True)
+            part_path = f"{path}.{os.getpid()}.part"
+            async with aiofiles.open(part_path, "wb") as f:
+                await f.write(body)
+            await aiofiles.os.replace(part_path, path)
+        for removed in await self._run(self._insert, url, digest, content_type, len(body)):
+            try:
+                await aiofiles.os.remove(self.blob_path(removed))
+            except OSError:
+                pass
+
+
+class RequestInterceptor:
+    """
+    通过 BrowserContext.route 拦截请求: 屏蔽无用请求, 静态资源优先从磁盘缓存返回
+    """
+    def __init__(self, cache: AssetCache = None, cache_hosts=(), cache_types=(), block_urls=(), block_types=()):
+        self.cache = cache
+        self.cache_hosts = set(cache_hosts)
+        self.cache_types = set(cache_types)
+        self.block_urls = list(block_urls)
+        self.block_types = set(block_types)
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_settings(cls, settings: dict):
+        cache_settings = settings.get("cache", {})
+        cache = None
+        if cache_settings.get("enabled", "false") == "true":
+            cache_dir = cache_settings.get("cache_dir") or os.path.join(settings["base"].get("data_dir") or DATA_DIR, "asset_cache")
+            cache = AssetCache(cache_dir, int(cache_settings.get("max_size") or 2048) * 1024 * 1024)
+        # 拦截请求后浏览器 HTTP 缓存不再生效, 默认屏蔽规则只在开启资源缓存时使用, 不开启缓存时不拦截请求
+        default_block_urls = DEFAULT_BLOCK_URLS if cache is not None else ""
+        default_block_types = DEFAULT_BLOCK_TYPES if cache is not None else ""
+        return cls(
+            cache,
+            cache_hosts=split_setting(cache_settings.get("cache_hosts", DEFAULT_CACHE_HOSTS)),
+            cache_types=split_setting(cache_settings.get("cache_types", DEFAULT_CACHE_TYPES)),
+            block_urls=split_setting(cache_settings.get("block_urls", default_block_urls)),
+            block_types=split_setting(cache_settings.get("block_types", default_block_types)),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.cache or self.block_urls or self.block_types)
+
+    def is_blocked(self, url: str, resource_type: str) -> bool:
+        if resource_type in self.block_types:
+            return True
+        return any(fnmatch.fnmatchcase(url, pattern) for pattern in self.block_urls)
+
+    def is_cacheable(self, url: str, method: str, resource_type: str) -> bool:
+        if self.cache is None or method != "GET" or resource_type not in self.cache_types:
+            return False
+        return urlsplit(url).hostname in self.cache_hosts
+
+    async def handle(self, route: Route):
+        request = route.request
+        url = request.url
+        try:
+            if self.is_blocked(url, request.resource_type):
+                await route.abort("blockedbyclient")
+                return
+            if not self.is_cacheable(url, request.method, request.resource_type):
+                await route.fallback()
+                return
+            cached = await self.cache.get(url)
+            if cached is not None:
+                self.hits += 1
+                body, content_type = cached
+                headers = {"access-control-allow-origin": "*"}
+                if content_type:
+                    headers["content-type"] = content_type
+                await route.fulfill(status=200, headers=headers, body=body)
+                return
+            self.misses += 1
+            response = await route.fetch()
+            body = await response.body()
+            await route.fulfill(response=response, body=body)
+        except playwright._impl._errors.Error as e:
+            # 页面已关闭或请求已经被处理, 忽略即可
+            logger.debug(f"拦截请求失败: {url}, 错误: {e}")
+            return
+        if response.status == 200 and body:
+            try:
+                await self.cache.put(url, body, response.headers.get("content-type"))
+            except OSError as e:
+                logger.warning(f"写入资源缓存失败: {url}, 错误: {e}")
+
+    async def open(self):
+        if self.cache is not None:
+            await self.cache.open()
+
+    async def close(self):
+        if self.cache is not None:
+            await self.cache.close()
@@ -0,0 +1,24 @@
+# 微信验证/风控页面的特征
+BLOCKED_URL_KEYWORDS = ("wappoc_appmsgcaptcha", "mp/verifycode", "secitptpage")
+BLOCKED_TEXT_KEYWORDS = ("环境异常", "完成验证后即可继续访问", "访问过于频繁")
+BLOCKED_CHECK_SCRIPT = """
+() => ({
+    hasContent: !!document.getElementById('js_content'),
+    text: document.body ? document.body.innerText.slice(0, 500) : '',
+})
+"""
+
+
+class BlockedPageError(Exception):
+    """
+    打开文章时被微信要求验证, 需要降低速率后重新下载
+    """
+
+
+def is_blocked_page(url: str, has_content: bool, text: str) -> bool:
+    """
+    根据页面地址和正文判断是否为验证页面
+    """
+    if any(keyword in url for keyword in BLOCKED_URL_KEYWORDS):
+        return True
+    return not has_content and any(keyword in text for keyword in BLOCKED_TEXT_KEYWORDS)
@@ -0,0 +1,95 @@
+import re
+import httpx
+from loguru import logger
+from .blocked import BlockedPageError, is_blocked_page
+
+
+DEFAULT_USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36"
+)
+DEFAULT_HEADERS = {
+    "User-Agent": DEFAULT_USER_AGENT,
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8",
+    "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8",
+}
+# 懒加载图片的真实地址放在 data-src 中, 浏览器里由 readiness 脚本替换
+IMG_TAG_PATTERN = re.compile(r'<img\b[^>]*>', re.I)
+DATA_SRC_PATTERN = re.compile(r'\sdata-src\s*=\s*(["\'])(.*?)\1', re.I | re.S)
+SRC_ATTR_PATTERN = re.compile(r'\ssrc\s*=\s*(["\']).*?\1', re.I | re.S)
+# 正文容器默认隐藏, 由页面脚本加载完成后才显示
+HIDDEN_CONTENT_PATTERN = re.compile(r'(id="js_content"[^>]*?style="[^"]*?)visibility:\s*hidden;?', re.I)
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _rewrite_img(match: re.Match) -> str:
+    tag = match.group(0)
+    data_src = DATA_SRC_PATTERN.search(tag)
+    if data_src is None:
+        return tag
+    src = f' src="{data_src.group(2)}"'
+    if SRC_ATTR_PATTERN.search(tag):
+        return SRC_ATTR_PATTERN.sub(lambda _: src, tag, count=1)
+    return tag[:4] + src + tag[4:]
+
+
+def prepare_article_html(content: str) -> str:
+    """
+    把直接请求得到的文章源码处理成和浏览器中一致的可离线查看的 html
+    """
+    content = IMG_TAG_PATTERN.sub(_rewrite_img, content)
+    return HIDDEN_CONTENT_PATTERN.sub(r'\1', content)
+
+
+class HttpArticleFetcher:
+    """
+    不经过浏览器直接请求文章页面, 只用于保存 html 的场景
+    """
+    def __init__(self, connections: int = 10, timeout: float = 30):
+        http2 = _http2_available()
+        if not http2:
+            logger.info("未安装 h2, 直接请求文章时使用 HTTP/1.1")
+        self.client = httpx.AsyncClient(
+            http2=http2,
+            headers=DEFAULT_HEADERS,
+            follow_redirects=True,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=connections, max_keepalive_connections=connections),
+        )
+        self.hits = 0
+        self.fallbacks = 0
+
+    @classmethod
+    def from_settings(cls, settings: dict):
+        base = settings["base"]
+        if base.get("http_engine", "false") != "true":
+            return None
+        return cls(connections=int(base.get("http_connections") or 10))
+
+    async def fetch(self, url: str):
+        """
+        返回处理后的 html, 页面内容不完整时返回 None, 遇到验证页面时抛出 BlockedPageError
+        """
+        resp = await self.client.get(url)
+        resp.raise_for_status()
+        content = resp.text
+        has_content = 'id="js_content"' in content
+        if is_blocked_page(str(resp.url), has_content, content):
+            self.fallbacks += 1
+            raise BlockedPageError(str(resp.url))
+        if not has_content:
+            self.fallbacks += 1
+            logger.info(f"直接请求的页面中没有正文, 改用浏览器下载: {url}")
+            return None
+        self.hits += 1
+        return prepare_article_html(content)
+
+    async def close(self):
+        await self.client.aclose()
@@ -0,0 +1,78 @@
+import re
+
+
+# -webkit-/-moz-/-ms-user-select:none 都以 user-select:none 结尾, 替换结果相同, 合并为一项
+LITERAL_REPLACEMENTS = (
+    ("window.location.protocol", "https:"),
+    ("location.protocol", "https://"),
+    ("-webkit-user-select: none", "-webkit-user-select:text"),
+    ("user-select:none", "user-select:text"),
+)
+# 依次执行, 顺序和原来相同; url 的替换模板会保留反斜杠, 保持原来的输出
+LINK_REPLACEMENTS = (
+    (re.compile(r'src="//(.*?)"'), r'src="https://\1"'),
+    (re.compile(r'url\(//(.*?)\)'), r'url\(https://\1\)'),
+    (re.compile(r'href="//(.*?)"'), r'href="https://\1"'),
+)
+# 替换的内容都不跨行, 按行切块后逐块替换的结果和整篇替换相同
+HTML_CHUNK_SIZE = 256 * 1024
+
+
+def legacy_format_html(content: str) -> str:
+    """
+    原来整篇逐项替换的实现, 用于检查 format_html 的结果
+    """
+    if not content:
+        return ""
+    content = content.replace('window.location.protocol', 'https:')
+    content = content.replace('location.protocol', 'https://')
+    content = content.replace('-webkit-user-select:none', '-webkit-user-select:text')
+    content = content.replace('-webkit-user-select: none', '-webkit-user-select:text')
+    content = content.replace('-moz-user-select:none', '-moz-user-select:text')
+    content = content.replace('-ms-user-select:none', '-ms-user-select:text')
+    content = content.replace('user-select:none', 'user-select:text')
+    content = re.sub(r'src="//(.*?)"', r'src="https://\1"', content)
+    content = re.sub(r'url\(//(.*?)\)', r'url\(https://\1\)', content)
+    content = re.sub(r'href="//(.*?)"', r'href="https://\1"', content)
+    return content.strip()
+
+
+def format_html_chunk(chunk: str) -> str:
+    for old, new in LITERAL_REPLACEMENTS:
+        chunk = chunk.replace(old, new)
+    # 协议相对链接都带有 //, 没有时跳过正则
+    if "//" in chunk:
+        for pattern, template in LINK_REPLACEMENTS:
+            chunk = pattern.sub(template, chunk)
+    return chunk
+
+
+def iter_format_html(content: str, chunk_size: int = HTML_CHUNK_SIZE):
+    """
+    按行切块逐块替换, 写文件时边替换边写入, 不生成整篇替换后的副本
+    """
+    if not content:
+        return
+    # 和 strip 相同地跳过首尾空白, 不复制整篇
+    start, length = 0, len(content)
+    while start < length and content[start].isspace():
+        start += 1
+    while length > start and content[length - 1].isspace():
+        length -= 1
+    while start < length:
+        end = content.find("\n", start + chunk_size, length)
+        end = length if end < 0 else end + 1
+        yield format_html_chunk(content[start:end])
+        start = end
+
+
+def format_html(content: str) -> str:
+    """
+    替换页面中的协议相对链接和禁止选中文字的样式, 结果与 legacy_format_html 逐字节一致
+    """
+    if not content:
+        return ""
+    content = content.strip()
+    if len(content) <= HTML_CHUNK_SIZE:
+        return format_html_chunk(content)
+    return "".join(iter_format_html(content))
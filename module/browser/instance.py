@@ -0,0 +1,176 @@
+import os
+import asyncio
+import playwright
+from loguru import logger
+from playwright.async_api import async_playwright, BrowserContext, Playwright, Browser, Page
+from .pool import TabPool
+from .profile import profile_in_use
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def _find_profile_browser(user_data_dir: str) -> int:
+    """
+    按命令行中的用户数据目录找到浏览器主进程, 同一个用户数据目录只会被一个浏览器使用
+    """
+    target = os.path.normcase(os.path.abspath(user_data_dir))
+    for process in psutil.Process(os.getpid()).children(recursive=True):
+        try:
+            cmdline = process.cmdline()
+        except psutil.Error:
+            continue
+        # 渲染、GPU 等子进程的命令行带有 --type=
+        if any(arg.startswith("--type=") for arg in cmdline):
+            continue
+        for arg in cmdline:
+            if arg.startswith("--user-data-dir=") and os.path.normcase(os.path.abspath(arg.split("=", 1)[1])) == target:
+                return process.pid
+    return None
+
+
+class BrowserInstance:
+    """
+    一个浏览器进程及其上下文和标签页池, 由 ChromeManager 负责创建、替换和回收
+    """
+    def __init__(self, chrome_manager, generation: int):
+        self.chrome_manager = chrome_manager
+        self.generation = generation
+        self.tab_pool = TabPool(chrome_manager.max_tabs, chrome_manager.tab_max_uses)
+        self.pages_served = 0
+        self.checked_out = 0
+        # 连续超时的次数, 超过阈值说明渲染进程可能已经卡死
+        self.timeouts = 0
+        self.retired = False
+        self.closed = False
+        self.drained = asyncio.Event()
+        self.drained.set()
+        self._browser_pid: int = None
+        self._playwright_manager: Playwright = None
+        self._playwright_browser: Browser = None
+        self._playwright_contexts: list[BrowserContext] = []
+
+    @property
+    def contexts(self) -> list[BrowserContext]:
+        return self._playwright_contexts
+
+    async def start(self):
+        manager = self.chrome_manager
+        self._playwright_manager = await async_playwright().start()
+        if manager.user_data_dir and not profile_in_use(manager.user_data_dir):
+            context = await self._playwright_manager.chromium.launch_persistent_context(
+                manager.user_data_dir,
+                headless=manager.headless,
+                executable_path=manager.executable_path,
+                channel="chromium",
+                args=manager.default_chrome_args + [f"--disk-cache-size={manager.disk_cache_size}"],
+                **manager.context_options
+            )
+            self._playwright_browser = context.browser
+            self._playwright_contexts = [context]
+        else:
+            if manager.user_data_dir:
+                logger.warning(f"浏览器用户数据目录正在被其他浏览器使用, 本次使用临时配置启动: {manager.user_data_dir}")
+            self._playwright_browser = await self._playwright_manager.chromium.launch(
+                headless=manager.headless,
+                executable_path=manager.executable_path,
+                channel="chromium",
+                args=manager.default_chrome_args
+            )
+            self._playwright_contexts = [
+                await self._playwright_browser.new_context(**manager.context_options)
+                for _ in range(manager.context_count)
+            ]
+        if manager.interceptor.enabled:
+            for context in self._playwright_contexts:
+                await context.route("**/*", manager.interceptor.handle)
+        self.tab_pool.reset(self._playwright_contexts)
+        if psutil is not None:
+            self._browser_pid = await self._find_browser_pid()
+
+    async def _find_browser_pid(self) -> int:
+        """
+        浏览器主进程的 PID, 渲染进程和 GPU 进程都是它的子进程; 同时启动的其他浏览器不会被算进来
+        """
+        if self._playwright_browser is None:
+            # 旧版本 playwright 的持久化配置没有 Browser 对象, 无法打开浏览器级别的 CDP 会话
+            return await asyncio.to_thread(_find_profile_browser, self.chrome_manager.user_data_dir)
+        try:
+            session = await self._playwright_browser.new_browser_cdp_session()
+            try:
+                info = await session.send("SystemInfo.getProcessInfo")
+            finally:
+                await session.detach()
+        except playwright._impl._errors.Error as e:
+            logger.info(f"获取浏览器进程信息失败, 不按内存回收浏览器: {e}")
+            return None
+        for process in info.get("processInfo", []):
+            if process.get("type") == "browser":
+                return process["id"]
+        return None
+
+    def is_connected(self) -> bool:
+        if self._playwright_browser is not None:
+            return self._playwright_browser.is_connected()
+        return bool(self._playwright_contexts)
+
+    def rss(self) -> int:
+        """
+        浏览器所有进程占用的内存, 没有安装 psutil 时返回 None
+        """
+        if psutil is None or self._browser_pid is None:
+            return None
+        try:
+            browser = psutil.Process(self._browser_pid)
+            processes = [browser, *browser.children(recursive=True)]
+        except psutil.Error:
+            return None
+        total = 0
+        for process in processes:
+            try:
+                total += process.memory_info().rss
+            except psutil.Error:
+                continue
+        return total
+
+    async def acquire(self) -> Page:
+        page = await self.tab_pool.acquire()
+        self.checked_out += 1
+        self.pages_served += 1
+        self.drained.clear()
+        return page
+
+    async def release(self, page: Page, reusable: bool = True):
+        try:
+            await self.tab_pool.release(page, reusable and not self.retired and not self.closed)
+        finally:
+            self.checked_out -= 1
+            if reusable:
+                self.timeouts = 0
+            if self.checked_out == 0:
+                self.drained.set()
+
+    async def _cleanup_playwright(self, playwright_obj):
+        if playwright_obj:
+            try:
+                await playwright_obj.close()
+            except playwright._impl._errors.TargetClosedError:
+                pass
+            except Exception as e:
+                logger.info(f"处理浏览器关闭异常: {e}")
+
+    async def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        await self.tab_pool.close()
+        for context in self._playwright_contexts:
+            await self._cleanup_playwright(context)
+        await self._cleanup_playwright(self._playwright_browser)
+        if self._playwright_manager:
+            try:
+                await self._playwright_manager.stop()
+            except Exception as e:
+                logger.info(f"关闭 playwright 驱动异常: {e}")
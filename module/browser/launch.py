@@ -1,100 +1,282 @@
-import asyncio
-import playwright
-from loguru import logger
-from fastapi import FastAPI
-from playwright.async_api import async_playwright, BrowserContext, Playwright, Browser
-from ..settings import CHROMIUM_EXECUTABLE_PATH
-
-
-class ChromeManager:
-
-    default_chrome_args = [
-        "--disable-dev-shm-usage",
-        "--no-sandbox",
-        "--disable-blink-features=AutomationControlled",
-        "--deny-permission-prompts",
-        '--disable-notifications',
-        "--disable-background-networking",
-        "--disable-background-timer-throttling",
-        "--disable-backgrounding-occluded-windows",
-        "--disable-breakpad",
-        "--disable-client-side-phishing-detection",
-        "--disable-component-extensions-with-background-pages",
-        "--disable-default-apps",
-        "--disable-extensions",
-        "--disable-features=TranslateUI",
-        "--disable-hang-monitor",
-        "--disable-ipc-flooding-protection",
-        "--disable-popup-blocking",
-        "--disable-prompt-on-repost",
-        "--disable-sync",
-        "--force-color-profile=srgb",
-        "--metrics-recording-only",
-        "--no-first-run",
-        "--password-store=basic",
-        "--use-mock-keychain",
-    ]
-
-    def __init__(self, app: FastAPI=None, settings: dict=None):
-        self.app = app
-        self.headless = {"true": True, "false": False}[settings["base"].get("headless", "false")]
-        self.executable_path = settings["base"].get("chrome_path") or CHROMIUM_EXECUTABLE_PATH
-        self._playwright_manager:Playwright = None
-        self._playwright_browser:Browser = None
-        self._playwright_context:BrowserContext = None
-        self._playwright_browser_lock = asyncio.Lock()
-        self._playwright_screenshot_lock = asyncio.Lock()
-        self._browser_event = asyncio.Event()
-        self._exit = False
-    
-    async def _launch(self):
-        if self._browser_event.is_set():
-            return
-        await self._cleanup()
-        async with self._playwright_browser_lock:
-            self._playwright_manager =  await async_playwright().start()
-            self._playwright_browser = await self._playwright_manager.chromium.launch(
-                headless=self.headless,
-                executable_path=self.executable_path,
-                channel="chromium",
-                slow_mo=50,
-                args=self.default_chrome_args
-            ) 
-            self._playwright_context = await self._playwright_browser.new_context(
-                viewport={"width": 1440, "height": 980},
-                ignore_https_errors=True,
-                accept_downloads=False,
-            )
-            await self.create_tab()
-        self._browser_event.set()
-    
-    async def launch(self):
-        await self._launch()
-    
-    async def create_tab(self):
-        page = await self._playwright_context.new_page()
-        return page
-    
-    async def __aenter__(self):
-        self._browser_event.clear()
-        await self.launch()
-        return {"chrome_manager":self}
-    
-    async def _cleanup_playwright(self, playwright_obj):
-        if playwright_obj:
-            try:
-                await playwright_obj.close()
-            except playwright._impl._errors.TargetClosedError:
-                pass
-            except Exception as e:
-                logger.info(f"处理浏览器关闭异常: {e}")
-    
-    async def _cleanup(self):
-        await self._cleanup_playwright(self._playwright_context)
-        await self._cleanup_playwright(self._playwright_browser)
-        await self._cleanup_playwright(self._playwright_manager)
-        
-    async def __aexit__(self, exc_type, exc_val, exc_tb):
-        self._exit = True
-        await self._cleanup()
-        
+import asyncio
+import playwright
+from loguru import logger
+from fastapi import FastAPI
+from playwright.async_api import Page
+from .asset_cache import RequestInterceptor
+from .instance import BrowserInstance
+from ..settings import CHROMIUM_EXECUTABLE_PATH
+from ..tools.metrics import BROWSER_RESTARTS, BROWSER_RSS
+
+
+# 处理的页面数达到回收阈值的该比例时开始预启动备用浏览器
+STANDBY_PRELAUNCH_RATIO = 0.9
+# 同一个浏览器连续多少次阶段超时后回收
+MAX_STAGE_TIMEOUTS = 3
+# 回收浏览器时等待正在处理的页面完成的最长时间(秒)
+RECYCLE_DRAIN_TIMEOUT = 120
+# 看门狗检查浏览器状态的间隔(秒)
+WATCHDOG_INTERVAL = 30
+
+
+class ChromeManager:
+
+    default_chrome_args = [
+        "--disable-dev-shm-usage",
+        "--no-sandbox",
+        "--disable-blink-features=AutomationControlled",
+        "--deny-permission-prompts",
+        '--disable-notifications',
+        "--disable-background-networking",
+        "--disable-background-timer-throttling",
+        "--disable-backgrounding-occluded-windows",
+        "--disable-breakpad",
+        "--disable-client-side-phishing-detection",
+        "--disable-component-extensions-with-background-pages",
+        "--disable-default-apps",
+        "--disable-extensions",
+        "--disable-features=TranslateUI",
+        "--disable-hang-monitor",
+        "--disable-ipc-flooding-protection",
+        "--disable-popup-blocking",
+        "--disable-prompt-on-repost",
+        "--disable-sync",
+        "--force-color-profile=srgb",
+        "--metrics-recording-only",
+        "--no-first-run",
+        "--password-store=basic",
+        "--use-mock-keychain",
+    ]
+
+    context_options = {
+        "viewport": {"width": 1440, "height": 980},
+        "ignore_https_errors": True,
+        "accept_downloads": False,
+    }
+
+    def __init__(self, app: FastAPI=None, settings: dict=None):
+        self.app = app
+        base = settings["base"]
+        self.headless = {"true": True, "false": False}[base.get("headless", "false")]
+        self.executable_path = base.get("chrome_path") or CHROMIUM_EXECUTABLE_PATH
+        self.context_count = max(int(base.get("contexts") or 1), 1)
+        self.max_tabs = int(base.get("max_tabs") or base.get("workers") or 1)
+        self.tab_max_uses = int(base.get("tab_max_uses") or 50)
+        self.interceptor = RequestInterceptor.from_settings(settings)
+        # 配置了用户数据目录时使用持久化的浏览器配置, 重启后保留 HTTP 缓存和 Cookie
+        self.user_data_dir = base.get("user_data_dir") or None
+        self.disk_cache_size = int(base.get("disk_cache_size") or 512) * 1024 * 1024
+        # 处理多少个页面或内存超过多少 MB 后回收浏览器, 0 表示不限制
+        self.recycle_pages = int(base.get("recycle_pages") or 0)
+        self.recycle_rss = int(base.get("recycle_rss") or 0) * 1024 * 1024
+        # 同一个用户数据目录不能同时被两个浏览器使用, 持久化配置时不预启动备用浏览器
+        self.standby = base.get("standby_browser", "false") == "true" and not self.user_data_dir
+        self.restarts = 0
+        self._active: BrowserInstance = None
+        self._standby_task: asyncio.Task = None
+        self._recycle_task: asyncio.Task = None
+        self._watchdog_task: asyncio.Task = None
+        self._owners: dict[Page, BrowserInstance] = {}
+        self._generation = 0
+        self._playwright_browser_lock = asyncio.Lock()
+        self._playwright_screenshot_lock = asyncio.Lock()
+        self._browser_event = asyncio.Event()
+        self._exit = False
+
+    async def _start_instance(self) -> BrowserInstance:
+        async with self._playwright_browser_lock:
+            self._generation += 1
+            instance = BrowserInstance(self, self._generation)
+            try:
+                await instance.start()
+            except BaseException:
+                await instance.close()
+                raise
+        logger.info(f"浏览器 #{instance.generation} 已启动")
+        return instance
+    
+    async def _launch(self):
+        if self._browser_event.is_set():
+            return
+        self._active = await self._start_instance()
+        self._browser_event.set()
+    
+    async def launch(self):
+        await self._launch()
+    
+    async def create_tab(self):
+        await self._browser_event.wait()
+        page = await self._active.contexts[0].new_page()
+        return page
+
+    async def acquire_tab(self):
+        while True:
+            await self._browser_event.wait()
+            instance = self._active
+            try:
+                page = await instance.acquire()
+            except playwright._impl._errors.Error:
+                if not instance.retired:
+                    raise
+                continue
+            if not instance.retired:
+                break
+            # 等待标签页期间浏览器被替换, 换到新的浏览器上
+            await instance.release(page, reusable=False)
+        self._owners[page] = instance
+        self._check_recycle(instance)
+        return page
+
+    def listen(self, page, event: str, handler):
+        """
+        给 acquire_tab 借出的标签页添加事件监听, release_tab 时自动移除
+        """
+        instance = self._owners.get(page)
+        if instance is None:
+            page.on(event, handler)
+            return
+        instance.tab_pool.listen(page, event, handler)
+
+    async def release_tab(self, page, reusable=True):
+        instance = self._owners.pop(page, None)
+        if instance is None:
+            try:
+                await page.close()
+            except playwright._impl._errors.Error:
+                pass
+            return
+        await instance.release(page, reusable)
+
+    async def report_crash(self, page):
+        """
+        标签页所在的浏览器已经关闭, 回收后重新启动, 任务由调用方放回队列
+        """
+        instance = self._owners.get(page)
+        await self.release_tab(page, reusable=False)
+        if instance is not None:
+            self.schedule_recycle(instance, "浏览器异常关闭")
+        if self._recycle_task is not None:
+            await asyncio.shield(self._recycle_task)
+
+    async def report_hang(self, page):
+        """
+        页面处理超时, 丢弃标签页; 连续超时或无法关闭标签页时回收整个浏览器
+        """
+        instance = self._owners.get(page)
+        try:
+            await asyncio.wait_for(self.release_tab(page, reusable=False), timeout=10)
+        except asyncio.TimeoutError:
+            logger.warning("关闭超时的标签页失败, 渲染进程可能已卡死")
+            if instance is not None:
+                instance.timeouts = MAX_STAGE_TIMEOUTS
+        if instance is not None:
+            instance.timeouts += 1
+            if instance.timeouts >= MAX_STAGE_TIMEOUTS:
+                self.schedule_recycle(instance, f"连续 {instance.timeouts} 次处理超时")
+
+    def _check_recycle(self, instance: BrowserInstance, rss: int = None):
+        if instance is not self._active or not self._browser_event.is_set():
+            return
+        reason = None
+        ratio = 0
+        if self.recycle_pages:
+            ratio = instance.pages_served / self.recycle_pages
+            if instance.pages_served >= self.recycle_pages:
+                reason = f"已处理 {instance.pages_served} 个页面"
+        if self.recycle_rss and rss is not None:
+            ratio = max(ratio, rss / self.recycle_rss)
+            if rss >= self.recycle_rss:
+                reason = f"内存占用 {rss // 1024 // 1024}MB"
+        if self.standby and self._standby_task is None and ratio >= STANDBY_PRELAUNCH_RATIO:
+            logger.info("预启动备用浏览器")
+            self._standby_task = asyncio.create_task(self._start_instance())
+        if reason:
+            self.schedule_recycle(instance, reason)
+
+    def schedule_recycle(self, instance: BrowserInstance, reason: str):
+        if instance is not self._active or self._exit:
+            return
+        if self._recycle_task is not None and not self._recycle_task.done():
+            return
+        self._recycle_task = asyncio.create_task(self._recycle(instance, reason))
+
+    def _standby_ready(self) -> bool:
+        task = self._standby_task
+        return task is not None and task.done() and not task.cancelled() and task.exception() is None
+
+    async def _take_standby(self) -> BrowserInstance:
+        task, self._standby_task = self._standby_task, None
+        if task is not None:
+            try:
+                return await task
+            except Exception as e:
+                logger.warning(f"备用浏览器启动失败, 重新启动浏览器: {e}")
+        return await self._start_instance()
+
+    async def _recycle(self, instance: BrowserInstance, reason: str):
+        self.restarts += 1
+        BROWSER_RESTARTS.inc()
+        logger.info(f"回收浏览器 #{instance.generation}: {reason}")
+        instance.retired = True
+        if not self._standby_ready():
+            # 没有启动完成的备用浏览器时先暂停领取标签页, 避免 acquire_tab 在已回收的浏览器上反复重试
+            self._browser_event.clear()
+        if self.standby:
+            # 先切换到备用浏览器, 旧浏览器等正在处理的页面完成后再关闭, 备用浏览器已启动时切换过程中没有空档
+            asyncio.create_task(self._close_when_drained(instance))
+        else:
+            await self._close_when_drained(instance)
+        while not self._exit:
+            try:
+                self._active = await self._take_standby()
+            except Exception as e:
+                logger.exception(f"重启浏览器失败, 稍后重试: {e}")
+                await asyncio.sleep(5)
+                continue
+            self._browser_event.set()
+            break
+
+    async def _close_when_drained(self, instance: BrowserInstance):
+        try:
+            await asyncio.wait_for(instance.drained.wait(), timeout=RECYCLE_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"浏览器 #{instance.generation} 仍有 {instance.checked_out} 个页面未完成, 强制关闭")
+        await instance.close()
+
+    async def _watchdog(self):
+        while not self._exit:
+            await asyncio.sleep(WATCHDOG_INTERVAL)
+            instance = self._active
+            if instance is None or not self._browser_event.is_set():
+                continue
+            if not instance.is_connected():
+                self.schedule_recycle(instance, "浏览器连接已断开")
+                continue
+            rss = instance.rss()
+            if rss is not None:
+                BROWSER_RSS.set(rss)
+            self._check_recycle(instance, rss)
+    
+    async def __aenter__(self):
+        await self.interceptor.open()
+        self._browser_event.clear()
+        await self.launch()
+        self._watchdog_task = asyncio.create_task(self._watchdog())
+        return {"chrome_manager":self}
+    
+    async def _cleanup(self):
+        for task in (self._watchdog_task, self._recycle_task, self._standby_task):
+            if task is not None and not task.done():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        if self._standby_task is not None and not self._standby_task.cancelled() and self._standby_task.exception() is None:
+            await self._standby_task.result().close()
+        for instance in {*self._owners.values(), self._active}:
+            if instance is not None:
+                await instance.close()
+        
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self._exit = True
+        self._browser_event.clear()
+        await self._cleanup()
+        await self.interceptor.close()
@@ -1,235 +1,299 @@
-import re
-import os
-import time
-import base64
-import asyncio
-import aiofiles
-import aiofiles.ospath
-import playwright
-from loguru import logger
-from playwright.async_api import Page, BrowserContext, CDPSession
-from .launch import ChromeManager
-
-
-class PlaywrightHtmlManager:
-    def __init__(self, chrome_manager: ChromeManager):
-        self.chrome_manager = chrome_manager
-
-    async def browser_get(self, options:dict) -> dict:
-        page = await self.chrome_manager.create_tab()
-        try:
-            result = await self._browser_get(page, options)
-        except playwright._impl._errors.TargetClosedError:
-            logger.exception("浏览器状态异常，可能被关闭，正在重启浏览器!") 
-            self.chrome_manager._browser_event.clear()
-            await self.chrome_manager.launch()
-            return await self.browser_get(options)
-        # except asyncio.exceptions.CancelledError:
-        #     logger.info("CancelledError, 请求被取消，正在关闭标签重新创建!")
-        except:
-            logger.exception("未知异常!")
-        await page.close()
-        return result
-    
-    async def _browser_get(self, page: Page, options: dict) -> dict:
-        url = options["url"]
-        title = options["title"]
-        nickname = options.get("nickname") or "默认路径"
-        pub_time = options["pub_time"]
-        save_path = self.chrome_manager.app.state.save_path
-        biz_path = os.path.join(save_path, nickname)
-        os.makedirs(biz_path, exist_ok=True)
-        filename = self._sanitize_filename(title)
-        filepath = os.path.join(biz_path, filename)
-        if await aiofiles.ospath.exists(f"{filepath}.pdf") and await aiofiles.ospath.exists(f"{filepath}.mhtml"):
-            logger.info(f"文件已存在，跳过下载: {filepath}.pdf 和 {filepath}.mhtml")
-            return 
-        await self._goto(page, url)
-        # 缓慢滚动页面到底部，确保图片等资源加载完成
-        await page.evaluate("""
-            async () => {
-                const delay = ms => new Promise(res => setTimeout(res, ms));
-                let totalHeight = 0;
-                let distance = 300;
-                while (totalHeight < document.body.scrollHeight) {
-                    window.scrollBy(0, distance);
-                    await delay(200);
-                    totalHeight += distance;
-                }
-                window.scrollTo(0, document.body.scrollHeight);
-                await delay(1000);
-            }
-        """)
-        await asyncio.sleep(3)  
-        download_type = self.chrome_manager.app.state.settings.get("download_type") or "pdf,mhtml,html"
-        download_type = download_type.lower().split(",")
-        if "pdf" in download_type:
-            await self._browser_save_pdf(page, filepath, pub_time)
-        if "mhtml" in download_type:
-            await self._browser_save_mhtml(page, filepath, pub_time)
-        if "html" in download_type:
-            await self._browser_get_html(page, filepath, pub_time)
-
-    async def set_file_times(self, path, pub_time):
-        if not await aiofiles.ospath.exists(path):
-            return
-        pub_timestamp = int(time.mktime(time.strptime(pub_time, "%Y-%m-%d %H:%M:%S")))
-        try:
-            os.utime(path, (pub_timestamp, pub_timestamp))
-        except Exception as e:
-            logger.warning(f"设置文件时间失败: {path}, 错误: {e}")
-
-    def format_html(self, content: str) -> str:
-        if not content:
-            return ""
-        content = content.replace('window.location.protocol', 'https:')
-        content = content.replace('location.protocol', 'https://')
-        content = content.replace('-webkit-user-select:none', '-webkit-user-select:text')
-        content = content.replace('-webkit-user-select: none', '-webkit-user-select:text')
-        content = content.replace('-moz-user-select:none', '-moz-user-select:text')
-        content = content.replace('-ms-user-select:none', '-ms-user-select:text')
-        content = content.replace('user-select:none', 'user-select:text')
-        content = re.sub(r'src="//(.*?)"', r'src="https://\1"', content)
-        content = re.sub(r'url\(//(.*?)\)', r'url\(https://\1\)', content)
-        content = re.sub(r'href="//(.*?)"', r'href="https://\1"', content)
-        return content.strip()
-    
-    async def _browser_get_html(self, page: Page, filepath, pub_time) -> str:
-        try:
-            content = await page.content()
-        except playwright._impl._errors.Error as e:
-            logger.info(f"_browser_get_html Error: {e}")
-            return
-        if not content:
-            logger.info("没有获取到 HTML 内容，可能是页面加载失败或不支持 HTML 格式")
-            return
-        file_path = f"{filepath}.html"
-        logger.info(f"保存 HTML 文件到: {file_path}")
-        async with aiofiles.open(file_path, "w", encoding="utf-8") as f:
-            await f.write(self.format_html(content))
-        await self.set_file_times(file_path, pub_time)
-
-    async def _browser_save_pdf(self, page: Page, filepath, pub_time) -> str:
-        context: BrowserContext = self.chrome_manager._playwright_context
-        client = None
-        logger.info("_browser_get_pdf start")
-        try:
-            client: CDPSession = await context.new_cdp_session(page)
-            result = await client.send("Page.printToPDF", {
-                "landscape": True,
-                "printBackground": True,
-                "preferCSSPageSize": True
-            })
-        except playwright._impl._errors.Error as e:
-            logger.info(f"_browser_get_pdf Error: {e}")
-        else:
-            pdf_content = result.get("data")
-            if not pdf_content:
-                logger.info("没有获取到 PDF 内容，可能是页面加载失败或不支持 PDF 格式")
-                return
-            pdf_content = base64.b64decode(pdf_content)
-            file_path = f"{filepath}.pdf"
-            logger.info(f"保存 PDF 文件到: {file_path}")
-            async with aiofiles.open(file_path, "wb") as f:
-                await f.write(pdf_content)
-            await self.set_file_times(file_path, pub_time)
-        finally:
-            if client:
-                await client.detach()
-
-    async def _browser_save_mhtml(self, page: Page, filepath, pub_time) -> str:
-        context: BrowserContext = self.chrome_manager._playwright_context
-        client = None
-        logger.info("_browser_get_mhtml start")
-        try:
-            client: CDPSession = await context.new_cdp_session(page)
-            result = await client.send("Page.captureSnapshot", {"format": "mhtml"})
-        except playwright._impl._errors.Error as e:
-            logger.info(f"_browser_get_mhtml Error: {e}")
-        else:
-            mhtml_content = result.get("data")
-            if not mhtml_content:
-                logger.info("没有获取到 mhtml 内容，可能是页面加载失败或不支持 mhtml 格式")
-                return
-            file_path = f"{filepath}.mhtml"
-            logger.info(f"保存 mhtml 文件到: {file_path}")
-            async with aiofiles.open(file_path, "w", newline="") as f:
-                await f.write(mhtml_content)
-            await self.set_file_times(file_path, pub_time)
-        finally:
-            if client:
-                await client.detach()
-    
-    def _sanitize_filename(self, filename: str) -> str:
-        # 移除或替换 Windows 文件名非法字符以及换行符、制表符等不可见字符
-        filename = re.sub(r'[\r\n\t]', '', filename)
-        filename = re.sub(r'[\\/:*?"<>|]', '_', filename)
-        # 限制文件名长度，避免过长导致的问题
-        if len(filename) > 50:
-            filename = filename[:50]
-        return filename.strip()
-
-    async def _stop_page_loading(self, page: Page):
-        context: BrowserContext = self.chrome_manager._playwright_context
-        client = None
-        logger.info("_stop_page_loading start")
-        try:
-            client: CDPSession = await context.new_cdp_session(page)
-            result = await client.send("Page.stopLoading")
-            # result = await page.evaluate('() => window.stop()')
-        except playwright._impl._errors.Error as e:
-            logger.info(f"_stop_page_loading Error: {e}")
-        else:
-            logger.info(f"_stop_page_loading result: {result}")
-        finally:
-            if client:
-                await client.detach()
-
-    async def _goto(self, page: Page, url, retry=0) -> dict:
-        try:
-            await page.goto(url, wait_until="networkidle", timeout=15000)
-        except playwright._impl._errors.TimeoutError:
-            logger.info(f"({url})请求超时, 尝试停止页面加载")
-            try:
-                await asyncio.wait_for(self._stop_page_loading(page), timeout=2)
-            except asyncio.exceptions.TimeoutError:
-                pass
-            return {"ok": True}
-        except playwright._impl._errors.Error:
-            logger.exception(f"({url})请求异常")
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+import re
+import time
+import sqlite3
+import asyncio
+import functools
+import httpx
+import playwright
+from loguru import logger
+from playwright.async_api import Page, CDPSession
+from .launch import ChromeManager
+from .readiness import NetworkTracker, wait_page_ready
+from .blocked import BlockedPageError, BLOCKED_CHECK_SCRIPT, is_blocked_page
+from .fetcher import HttpArticleFetcher
+from .html_format import format_html, iter_format_html
+from .renderer import print_to_pdf, enqueue_render
+from ..storage.image_store import ImageStore
+from ..storage.output import FileOutput, WarcOutput
+from ..storage.search_index import SearchIndex
+from ..tools import parse_download_types
+from ..tools.metrics import STAGE_TIMEOUTS, BYTES_WRITTEN, observe_stage, stage_timer
+
+
+class StageTimeoutError(Exception):
+    """
+    页面处理的某个阶段超时, 通常是渲染进程卡死
+    """
+    def __init__(self, stage: str, timeout: float):
+        super().__init__(f"{stage} 阶段超过 {timeout}s 未完成")
+        self.stage = stage
+
+
+class PlaywrightHtmlManager:
+    def __init__(self, chrome_manager: ChromeManager):
+        self.chrome_manager = chrome_manager
+        self.ready_timeout = float(chrome_manager.app.state.settings.get("ready_timeout") or 10)
+        self.capture_timeout = float(chrome_manager.app.state.settings.get("capture_timeout") or 120)
+        self.fetcher: HttpArticleFetcher = getattr(chrome_manager.app.state, "http_fetcher", None)
+        self.print_options: dict = chrome_manager.app.state.pdf_options
+        # 延后打印时只保存 mhtml, PDF 由打印队列从 mhtml 离线生成
+        self.render_queue = getattr(chrome_manager.app.state, "render_queue", None)
+        self.image_store: ImageStore = getattr(chrome_manager.app.state, "image_store", None)
+        self.output: FileOutput | WarcOutput = chrome_manager.app.state.output
+        self.search_index: SearchIndex = getattr(chrome_manager.app.state, "search_index", None)
+
+    async def browser_get(self, options:dict) -> dict:
+        # 单独运行的打印 worker 会在其他进程中写入 pdf, 判断缺少的格式前先读取最新记录
+        await self.chrome_manager.app.state.article_index.reload(options["url"])
+        article = self._prepare(options)
+        if article is None:
+            return
+        if self.render_queue is not None and "pdf" in article["download_type"]:
+            self._defer_pdf(article)
+            if not article["download_type"]:
+                await enqueue_render(self.render_queue, article)
+                return
+        if self.fetcher is not None and article["download_type"] == ["html"]:
+            result = await self._http_get(article)
+            if result is not None:
+                return result
+        page = await self.chrome_manager.acquire_tab()
+        try:
+            result = await self._browser_get(page, article)
+        except playwright._impl._errors.TargetClosedError:
+            logger.exception("浏览器状态异常，可能被关闭，正在重启浏览器!") 
+            await self.chrome_manager.report_crash(page)
+            raise
+        except BlockedPageError:
+            await self.chrome_manager.release_tab(page)
+            raise
+        except StageTimeoutError as e:
+            logger.warning(f"页面处理超时: {e}, {options['url']}")
+            await self.chrome_manager.report_hang(page)
+            raise
+        # except asyncio.exceptions.CancelledError:
+        #     logger.info("CancelledError, 请求被取消，正在关闭标签重新创建!")
+        except:
+            logger.exception("未知异常!")
+            await self.chrome_manager.release_tab(page, reusable=False)
+            raise
+        await self.chrome_manager.release_tab(page)
+        return result
+
+    def _defer_pdf(self, article: dict):
+        download_type = article["download_type"]
+        download_type.remove("pdf")
+        article["render_pdf"] = True
+        # 打印需要 mhtml, 已经保存过 mhtml 时直接添加打印任务
+        if "mhtml" not in download_type and not self.chrome_manager.app.state.article_index.is_downloaded(article["url"], ["mhtml"]):
+            download_type.append("mhtml")
+
+    async def _http_get(self, article: dict):
+        """
+        只保存 html 时直接请求文章页面, 遇到验证页面或内容不完整时返回 None 改用浏览器
+        """
+        try:
+            with stage_timer("http_fetch"):
+                content = await self.fetcher.fetch(article["url"])
+        except BlockedPageError:
+            logger.info(f"直接请求遇到验证页面, 改用浏览器下载: {article['url']}")
+            return None
+        except httpx.HTTPError as e:
+            logger.info(f"直接请求文章失败, 改用浏览器下载: {article['url']}, 错误: {e!r}")
+            return None
+        if content is None:
+            return None
+        return self._save_outputs({"html": content}, article)
+    
+    async def _run_stage(self, stage: str, coro, timeout: float):
+        started = time.perf_counter()
+        try:
+            return await asyncio.wait_for(coro, timeout=timeout)
+        except asyncio.TimeoutError:
+            STAGE_TIMEOUTS.labels(stage).inc()
+            raise StageTimeoutError(stage, timeout) from None
+        finally:
+            observe_stage(stage, time.perf_counter() - started)
+
+    async def _timed(self, stage: str, coro):
+        with stage_timer(stage):
+            return await coro
+
+    def _prepare(self, options: dict) -> dict:
+        url = options["url"]
+        title = options["title"]
+        nickname = options.get("nickname") or "默认路径"
+        article_index = self.chrome_manager.app.state.article_index
+        download_type = article_index.missing_formats(url, parse_download_types(self.chrome_manager.app.state.settings))
+        if not download_type:
+            logger.info(f"文章已下载，跳过: {title}({url})")
+            return 
+        filename = article_index.assign_filename(url, nickname, self._sanitize_filename(title))
+        return {
+            "url": url,
+            "nickname": nickname,
+            "filename": filename,
+            "title": title,
+            "pub_time": options["pub_time"],
+            "download_type": download_type,
+        }
+
+    async def _browser_get(self, page: Page, article: dict) -> dict:
+        url = article["url"]
+        download_type = article["download_type"]
+        # 整个页面只使用一个 CDP 会话, 停止加载和保存各种格式都复用它
+        client: CDPSession = await self._run_stage("cdp", page.context.new_cdp_session(page), 10)
+        tracker = NetworkTracker(page, functools.partial(self.chrome_manager.listen, page))
+        try:
+            await self._run_stage("goto", self._goto(page, client, url), 30)
+            await self._check_blocked(page)
+            await self._run_stage("ready", wait_page_ready(page, tracker, self.ready_timeout), self.ready_timeout + 10)
+            outputs = await self._run_stage("capture", self._capture(page, client, article, download_type), self.capture_timeout)
+        finally:
+            tracker.detach()
+            await self._detach(client)
+        # 返回写文件的协程, 由调用方在后台执行, 不占用标签页
+        return self._save_outputs(outputs, article)
+
+    async def _check_blocked(self, page: Page):
+        try:
+            result = await page.evaluate(BLOCKED_CHECK_SCRIPT)
+        except playwright._impl._errors.Error:
+            result = {"hasContent": True, "text": ""}
+        if is_blocked_page(page.url, result["hasContent"], result["text"]):
+            raise BlockedPageError(page.url)
+
+    async def _capture(self, page: Page, client: CDPSession, article: dict, download_type: list[str]) -> dict:
+        # 三种格式同时获取, 不再一个接一个地等待
+        captures = {}
+        if "pdf" in download_type:
+            captures["pdf"] = self._timed("capture_pdf", self._browser_save_pdf(client, self.output.part_path(article, "pdf")))
+        if "mhtml" in download_type:
+            captures["mhtml"] = self._timed("capture_mhtml", self._browser_save_mhtml(client))
+        if "html" in download_type:
+            captures["html"] = self._timed("capture_html", self._browser_get_html(page))
+        results = await asyncio.gather(*captures.values())
+        return {fmt: content for fmt, content in zip(captures, results) if content}
+
+    async def _save_outputs(self, outputs: dict, article: dict) -> list[str]:
+        with stage_timer("save"):
+            return await self._save(outputs, article)
+
+    async def _save(self, outputs: dict, article: dict) -> list[str]:
+        saved = []
+        if self.image_store is not None and outputs.get("html"):
+            outputs["html"] = await self._localize_images(outputs, article)
+        # 延后打印时 mhtml 在打印完 PDF 后再精简
+        if self.image_store is not None and self.image_store.slim_mhtml and outputs.get("mhtml") and not article.get("render_pdf"):
+            outputs["mhtml"] = await self._slim_mhtml(outputs["mhtml"], article)
+        for fmt, content in outputs.items():
+            target = self.output.target(article, fmt)
+            logger.info(f"保存 {fmt} 文件到: {target}")
+            try:
+                # html 在写文件的线程中逐块替换后写入
+                size = await self.output.write(article, fmt, iter_format_html(content) if fmt == "html" else content)
+            except OSError as e:
+                logger.warning(f"保存文件失败: {target}, 错误: {e}")
+                continue
+            BYTES_WRITTEN.labels(fmt).inc(size)
+            saved.append(fmt)
+        await self.chrome_manager.app.state.article_index.record(article["url"], article["nickname"], article["filename"], saved)
+        if self.search_index is not None and ("html" in saved or "mhtml" in saved):
+            await self._index_text(outputs, article, "html" if "html" in saved else "mhtml")
+        if article.get("render_pdf") and self.chrome_manager.app.state.article_index.is_downloaded(article["url"], ["mhtml"]):
+            await enqueue_render(self.render_queue, article)
+        return saved
+
+    async def _index_text(self, outputs: dict, article: dict, fmt: str):
+        # 全文索引失败不影响已经保存的文件
+        try:
+            with stage_timer("search_index"):
+                await self.search_index.add(article, outputs[fmt], fmt)
+        except (sqlite3.Error, ValueError) as e:
+            logger.warning(f"文章加入全文索引失败: {article['url']}, 错误: {e}")
+
+    async def _localize_images(self, outputs: dict, article: dict) -> str:
+        try:
+            return await self.image_store.localize_html(
+                outputs["html"], self.output.target(article, "html"), outputs.get("mhtml"), self.chrome_manager.interceptor.cache
+            )
+        except (OSError, ValueError) as e:
+            logger.warning(f"保存文章图片失败, html 保留原图片链接: {article['url']}, 错误: {e}")
+            return outputs["html"]
+
+    async def _slim_mhtml(self, mhtml: str, article: dict) -> str:
+        try:
+            return await self.image_store.slim_mhtml_content(mhtml, self.output.target(article, "mhtml"))
+        except (OSError, ValueError) as e:
+            logger.warning(f"精简 mhtml 图片失败, 保留完整的 mhtml: {article['url']}, 错误: {e}")
+            return mhtml
+
+    def format_html(self, content: str) -> str:
+        return format_html(content)
+    
+    async def _browser_get_html(self, page: Page) -> str:
+        try:
+            content = await page.content()
+        except playwright._impl._errors.Error as e:
+            logger.info(f"_browser_get_html Error: {e}")
+            return
+        if not content:
+            logger.info("没有获取到 HTML 内容，可能是页面加载失败或不支持 HTML 格式")
+            return
+        return content
+
+    async def _browser_save_pdf(self, client: CDPSession, part_path) -> str:
+        logger.info("_browser_get_pdf start")
+        # 分块读取 PDF 直接写入临时文件, 不在内存中保存整个 PDF
+        return await print_to_pdf(client, part_path, self.print_options)
+
+    async def _browser_save_mhtml(self, client: CDPSession) -> str:
+        logger.info("_browser_get_mhtml start")
+        try:
+            result = await client.send("Page.captureSnapshot", {"format": "mhtml"})
+        except playwright._impl._errors.Error as e:
+            logger.info(f"_browser_get_mhtml Error: {e}")
+            return
+        mhtml_content = result.get("data")
+        if not mhtml_content:
+            logger.info("没有获取到 mhtml 内容，可能是页面加载失败或不支持 mhtml 格式")
+            return
+        return mhtml_content
+
+    async def _detach(self, client: CDPSession):
+        try:
+            await client.detach()
+        except playwright._impl._errors.Error:
+            pass
+    
+    def _sanitize_filename(self, filename: str) -> str:
+        # 移除或替换 Windows 文件名非法字符以及换行符、制表符等不可见字符
+        filename = re.sub(r'[\r\n\t]', '', filename)
+        filename = re.sub(r'[\\/:*?"<>|]', '_', filename)
+        # 限制文件名长度，避免过长导致的问题
+        if len(filename) > 50:
+            filename = filename[:50]
+        return filename.strip()
+
+    async def _stop_page_loading(self, client: CDPSession):
+        logger.info("_stop_page_loading start")
+        try:
+            result = await client.send("Page.stopLoading")
+            # result = await page.evaluate('() => window.stop()')
+        except playwright._impl._errors.Error as e:
+            logger.info(f"_stop_page_loading Error: {e}")
+        else:
+            logger.info(f"_stop_page_loading result: {result}")
+
+    async def _goto(self, page: Page, client: CDPSession, url, retry=0) -> dict:
+        try:
+            await page.goto(url, wait_until="domcontentloaded", timeout=15000)
+        except playwright._impl._errors.TimeoutError:
+            logger.info(f"({url})请求超时, 尝试停止页面加载")
+            try:
+                await asyncio.wait_for(self._stop_page_loading(client), timeout=2)
+            except asyncio.exceptions.TimeoutError:
+                pass
+            return {"ok": True}
+        except playwright._impl._errors.Error:
+            logger.exception(f"({url})请求异常")
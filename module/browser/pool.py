@@ -0,0 +1,110 @@
+import asyncio
+import playwright
+from loguru import logger
+from playwright.async_api import BrowserContext, Page
+
+
+class TabPool:
+    """
+    标签页池, 复用已经创建好的 Page, 避免每个任务都重新创建标签页和渲染进程
+    """
+    def __init__(self, max_size: int = 1, max_uses: int = 50):
+        self.max_size = max(max_size, 1)
+        self.max_uses = max_uses
+        self._contexts: list[BrowserContext] = []
+        self._idle: list[Page] = []
+        self._uses: dict[Page, int] = {}
+        # 通过 listen 添加的事件监听, 归还标签页时移除
+        self._listeners: dict[Page, list[tuple]] = {}
+        self._semaphore = asyncio.Semaphore(self.max_size)
+        self._next_context = 0
+
+    def reset(self, contexts: list[BrowserContext]):
+        # 浏览器重启后旧的标签页全部失效, 直接丢弃
+        self._contexts = list(contexts)
+        self._idle.clear()
+        self._uses.clear()
+        self._listeners.clear()
+        self._next_context = 0
+
+    async def acquire(self) -> Page:
+        await self._semaphore.acquire()
+        try:
+            while self._idle:
+                page = self._idle.pop()
+                if await self._is_healthy(page):
+                    return page
+                await self._discard(page)
+            return await self._new_page()
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+    def listen(self, page: Page, event: str, handler):
+        """
+        给借出的标签页添加事件监听, 归还时自动移除, 不会带到下一个任务
+        """
+        page.on(event, handler)
+        self._listeners.setdefault(page, []).append((event, handler))
+
+    def _remove_listeners(self, page: Page):
+        for event, handler in self._listeners.pop(page, ()):
+            try:
+                page.remove_listener(event, handler)
+            except KeyError:
+                # 已经由添加者自己移除
+                pass
+
+    async def release(self, page: Page, reusable: bool = True):
+        self._remove_listeners(page)
+        try:
+            if reusable and page in self._uses and await self._reset_page(page):
+                self._uses[page] += 1
+                if self._uses[page] < self.max_uses:
+                    self._idle.append(page)
+                    return
+            await self._discard(page)
+        finally:
+            self._semaphore.release()
+
+    async def close(self):
+        pages = self._idle[:]
+        self._idle.clear()
+        for page in pages:
+            await self._discard(page)
+
+    async def _new_page(self) -> Page:
+        if not self._contexts:
+            raise RuntimeError("浏览器尚未启动, 无法创建标签页")
+        # 轮流在多个 BrowserContext 中创建标签页, 一个上下文出问题不会影响其他标签页
+        context = self._contexts[self._next_context % len(self._contexts)]
+        self._next_context += 1
+        page = await context.new_page()
+        self._uses[page] = 0
+        return page
+
+    async def _is_healthy(self, page: Page) -> bool:
+        if page.is_closed():
+            return False
+        try:
+            return await asyncio.wait_for(page.evaluate("1 + 1"), timeout=2) == 2
+        except (asyncio.TimeoutError, playwright._impl._errors.Error):
+            return False
+
+    async def _reset_page(self, page: Page) -> bool:
+        if page.is_closed():
+            return False
+        try:
+            await page.unroute_all(behavior="ignoreErrors")
+            await page.goto("about:blank", timeout=5000)
+        except playwright._impl._errors.Error as e:
+            logger.info(f"重置标签页失败, 丢弃该标签页: {e}")
+            return False
+        return True
+
+    async def _discard(self, page: Page):
+        self._uses.pop(page, None)
+        try:
+            await page.close()
+        except playwright._impl._errors.Error:
+            pass
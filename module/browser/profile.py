@@ -0,0 +1,40 @@
+import os
+import socket
+from loguru import logger
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def profile_in_use(user_data_dir: str) -> bool:
+    """
+    检查用户数据目录是否被其他 Chrome 占用, 上次异常退出留下的锁文件会被清理
+    """
+    singleton_lock = os.path.join(user_data_dir, "SingletonLock")
+    if os.path.islink(singleton_lock):
+        # Linux/macOS: SingletonLock 是指向 "主机名-进程号" 的符号链接
+        host, _, pid = os.readlink(singleton_lock).rpartition("-")
+        if host != socket.gethostname() or not pid.isdigit() or _pid_alive(int(pid)):
+            return True
+        logger.info(f"清理失效的浏览器锁文件: {singleton_lock}")
+        for name in ("SingletonLock", "SingletonSocket", "SingletonCookie"):
+            try:
+                os.remove(os.path.join(user_data_dir, name))
+            except OSError:
+                pass
+        return False
+    lockfile = os.path.join(user_data_dir, "lockfile")
+    if os.path.exists(lockfile):
+        # Windows: Chrome 运行时独占 lockfile, 能删除说明是上次异常退出留下的
+        try:
+            os.remove(lockfile)
+        except OSError:
+            return True
+    return False
@@ -0,0 +1,113 @@
+import asyncio
+import playwright
+from loguru import logger
+from playwright.async_api import Page, Request
+from ..tools.metrics import stage_timer
+
+
+# 网络请求停止后再等待的时间(秒), 避免请求之间的短暂空档被误判为加载完成
+NETWORK_QUIET_TIME = 0.3
+
+# 长连接或视频不影响页面保存, 不计入正在进行的请求
+IGNORED_RESOURCE_TYPES = {"websocket", "eventsource", "media", "manifest", "other"}
+
+# 微信文章的图片是懒加载的, 真实地址在 data-src 中, 直接替换后等待图片解码完成
+READY_SCRIPT = """
+async (timeout) => {
+    const deadline = Date.now() + timeout;
+    for (const img of document.querySelectorAll('img[data-src]')) {
+        const src = img.getAttribute('data-src');
+        if (src && img.getAttribute('src') !== src) {
+            img.setAttribute('src', src);
+        }
+        img.removeAttribute('loading');
+    }
+    // 部分懒加载依赖滚动事件, 滚动到底部再回到顶部触发一次
+    window.scrollTo(0, document.body.scrollHeight);
+    await new Promise(resolve => requestAnimationFrame(() => resolve()));
+    window.scrollTo(0, 0);
+    const pending = Array.from(document.images)
+        .filter(img => img.getAttribute('src') && !img.complete)
+        .map(img => img.decode().catch(() => {}));
+    if (document.fonts) {
+        pending.push(document.fonts.ready);
+    }
+    const remaining = Math.max(deadline - Date.now(), 0);
+    await Promise.race([
+        Promise.all(pending),
+        new Promise(resolve => setTimeout(resolve, remaining)),
+    ]);
+    return Array.from(document.images).filter(img => !img.complete).length;
+}
+"""
+
+
+class NetworkTracker:
+    """
+    记录页面正在进行的网络请求, 用于判断页面是否已经加载完成
+    """
+    def __init__(self, page: Page, listen=None):
+        self.page = page
+        self._inflight: set[Request] = set()
+        self._changed = asyncio.Event()
+        # 复用的标签页通过 ChromeManager.listen 添加监听, 即使没有 detach, 归还标签页时也会被移除
+        listen = listen or page.on
+        listen("request", self._on_request)
+        listen("requestfinished", self._on_finished)
+        listen("requestfailed", self._on_finished)
+
+    @property
+    def inflight(self) -> int:
+        return len(self._inflight)
+
+    def _on_request(self, request: Request):
+        if request.resource_type not in IGNORED_RESOURCE_TYPES:
+            self._inflight.add(request)
+            self._changed.set()
+
+    def _on_finished(self, request: Request):
+        self._inflight.discard(request)
+        self._changed.set()
+
+    def detach(self):
+        self.page.remove_listener("request", self._on_request)
+        self.page.remove_listener("requestfinished", self._on_finished)
+        self.page.remove_listener("requestfailed", self._on_finished)
+
+    async def wait_idle(self, timeout: float, quiet: float = NETWORK_QUIET_TIME) -> bool:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            self._changed.clear()
+            wait = min(quiet, remaining) if not self._inflight else remaining
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                if not self._inflight:
+                    return True
+
+
+async def wait_page_ready(page: Page, tracker: NetworkTracker, timeout: float) -> bool:
+    """
+    等待懒加载图片和网络请求完成, 最多等待 timeout 秒, 返回页面是否在超时前就绪
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    try:
+        with stage_timer("ready_script"):
+            pending_images = await asyncio.wait_for(page.evaluate(READY_SCRIPT, int(timeout * 1000)), timeout=timeout + 1)
+    except asyncio.TimeoutError:
+        logger.info(f"等待页面图片加载超时: {page.url}")
+        return False
+    except playwright._impl._errors.Error as e:
+        logger.info(f"等待页面图片加载失败: {e}")
+        return False
+    with stage_timer("network_idle"):
+        idle = await tracker.wait_idle(max(deadline - loop.time(), 0))
+    if pending_images or not idle:
+        logger.info(f"页面在 {timeout}s 内未完全加载, 未完成图片 {pending_images} 个, 请求 {tracker.inflight} 个")
+        return False
+    return True
@@ -0,0 +1,292 @@
+import os
+import sys
+import time
+import base64
+import asyncio
+import argparse
+import aiofiles
+import aiofiles.os
+import playwright
+from pathlib import Path
+from loguru import logger
+from playwright.async_api import async_playwright, Browser, BrowserContext, CDPSession, Playwright
+from ..settings import DATA_DIR, CHROMIUM_EXECUTABLE_PATH
+from ..storage.task_queue import SqliteTaskQueue
+from ..storage.article_index import ArticleIndex, normalize_article_url
+from ..storage.output import FileOutput, WarcOutput, create_output
+from ..storage.image_store import ImageStore, full_mhtml, read_mhtml
+from ..tools import read_ini_file
+from ..tools.metrics import stage_timer
+
+
+# 每次从 CDP 读取的 PDF 大小
+PDF_CHUNK_SIZE = 1024 * 1024
+# 打开 mhtml 的最长时间(秒), mhtml 不访问网络, 超时通常是渲染进程卡死
+RENDER_LOAD_TIMEOUT = 30
+# 单个 PDF 打印的最长时间(秒)
+RENDER_PRINT_TIMEOUT = 120
+
+
+def pdf_print_options(settings: dict) -> dict:
+    """
+    从 [pdf] 配置生成 Page.printToPDF 的参数, 即时打印和延后打印共用
+    """
+    pdf = settings.get("pdf", {})
+    options = {
+        "landscape": pdf.get("landscape", "true") == "true",
+        "printBackground": pdf.get("print_background", "true") == "true",
+        "preferCSSPageSize": pdf.get("prefer_css_page_size", "true") == "true",
+        "scale": float(pdf.get("scale") or 1),
+    }
+    # 纸张大小和页边距单位为英寸, 不配置时使用浏览器默认值
+    for key, name in (("paper_width", "paperWidth"), ("paper_height", "paperHeight"),
+                      ("margin_top", "marginTop"), ("margin_bottom", "marginBottom"),
+                      ("margin_left", "marginLeft"), ("margin_right", "marginRight")):
+        if pdf.get(key):
+            options[name] = float(pdf[key])
+    return options
+
+
+async def print_to_pdf(client: CDPSession, part_path: str, options: dict) -> str:
+    """
+    打印当前页面为 PDF, 分块读取后直接写入 part_path, 失败返回 None
+    """
+    try:
+        result = await client.send("Page.printToPDF", {**options, "transferMode": "ReturnAsStream"})
+    except playwright._impl._errors.Error as e:
+        logger.info(f"print_to_pdf Error: {e}")
+        return
+    stream = result.get("stream")
+    if not stream:
+        logger.info("没有获取到 PDF 内容，可能是页面加载失败或不支持 PDF 格式")
+        return
+    try:
+        async with aiofiles.open(part_path, "wb") as f:
+            while True:
+                chunk = await client.send("IO.read", {"handle": stream, "size": PDF_CHUNK_SIZE})
+                data = chunk.get("data")
+                if data:
+                    await f.write(base64.b64decode(data) if chunk.get("base64Encoded") else data.encode("utf-8"))
+                if chunk.get("eof"):
+                    break
+    except playwright._impl._errors.Error as e:
+        logger.info(f"print_to_pdf Error: {e}")
+        try:
+            await aiofiles.os.remove(part_path)
+        except OSError:
+            pass
+        return
+    finally:
+        try:
+            await client.send("IO.close", {"handle": stream})
+        except playwright._impl._errors.Error:
+            pass
+    return part_path
+
+
+def render_task(article: dict) -> dict:
+    """
+    延后打印的任务内容, 只需要找到已保存的 mhtml
+    """
+    return {
+        "url": article["url"],
+        "nickname": article["nickname"],
+        "filename": article["filename"],
+        "pub_time": article.get("pub_time"),
+    }
+
+
+async def enqueue_render(render_queue: SqliteTaskQueue, article: dict) -> int:
+    return await render_queue.put(render_task(article), dedupe_key=normalize_article_url(article["url"]),
+                                  account=article["nickname"])
+
+
+class PdfRenderer:
+    """
+    从已保存的 mhtml 离线打印 PDF, 使用独立的浏览器和离线上下文, 不访问网络
+    """
+    def __init__(self, render_queue: SqliteTaskQueue, article_index: ArticleIndex, output, print_options: dict,
+                 workers: int = 1, executable_path: str = None, image_store: ImageStore = None):
+        self.render_queue = render_queue
+        self.article_index = article_index
+        self.output: FileOutput | WarcOutput = output
+        self.print_options = print_options
+        self.workers = max(workers, 1)
+        self.executable_path = executable_path or CHROMIUM_EXECUTABLE_PATH
+        self.image_store = image_store
+        self.rendered = 0
+        self.busy = 0
+        self._playwright_manager: Playwright = None
+        self._browser: Browser = None
+        self._context: BrowserContext = None
+        self._tasks: list[asyncio.Task] = []
+        self._stop = asyncio.Event()
+
+    @classmethod
+    def from_settings(cls, settings: dict, render_queue: SqliteTaskQueue, article_index: ArticleIndex, output,
+                      workers: int = None):
+        pdf = settings.get("pdf", {})
+        return cls(
+            render_queue,
+            article_index,
+            output,
+            pdf_print_options(settings),
+            workers=int(pdf.get("renderers") or 1) if workers is None else workers,
+            executable_path=settings["base"].get("chrome_path"),
+            image_store=ImageStore.from_settings(settings, output),
+        )
+
+    async def start(self):
+        self._playwright_manager = await async_playwright().start()
+        # printToPDF 只在无头模式下可用, 打印与页面抓取互不影响
+        self._browser = await self._playwright_manager.chromium.launch(
+            headless=True,
+            executable_path=self.executable_path,
+            channel="chromium",
+            args=["--disable-dev-shm-usage", "--no-sandbox", "--disable-background-networking"],
+        )
+        # mhtml 已经包含全部资源, 离线并禁用脚本, 页面不会再访问微信
+        self._context = await self._browser.new_context(offline=True, java_script_enabled=False)
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info(f"已启动 {self.workers} 个 PDF 打印 worker")
+
+    async def _worker(self, worker_id=0):
+        while not self._stop.is_set():
+            task = await self.render_queue.get(timeout=1)
+            if task is None:
+                continue
+            task_id = task["task_id"]
+            self.busy += 1
+            try:
+                await self.render(task)
+            except asyncio.CancelledError:
+                await self.render_queue.requeue(task_id)
+                raise
+            except Exception as e:
+                retry = await self.render_queue.fail(task_id, repr(e))
+                logger.warning(f"[renderer-{worker_id}] 打印任务 {task_id} 失败, {'稍后重试' if retry else '不再重试'}: {e}")
+            else:
+                await self.render_queue.done(task_id)
+            finally:
+                self.busy -= 1
+
+    async def render(self, task: dict):
+        started = time.monotonic()
+        async with self.output.local_file(task, "mhtml") as mhtml_path:
+            if mhtml_path is None:
+                raise FileNotFoundError(self.output.target(task, "mhtml"))
+            # 精简过的 mhtml 先还原图片再打印
+            async with full_mhtml(mhtml_path) as print_path:
+                with stage_timer("render_pdf"):
+                    part_path = await self._print(print_path, self.output.part_path(task, "pdf"))
+        if part_path is None:
+            raise RuntimeError(f"打印 PDF 失败: {self.output.target(task, 'mhtml')}")
+        await self.output.write(task, "pdf", part_path)
+        if self.image_store is not None and self.image_store.slim_mhtml:
+            await self._slim(task)
+        await self.article_index.record(task["url"], task["nickname"], task["filename"], ["pdf"])
+        self.rendered += 1
+        logger.info(f"已打印 PDF ({time.monotonic() - started:.1f}s): {self.output.target(task, 'pdf')}")
+
+    async def _slim(self, task: dict):
+        # PDF 已经打印完成, mhtml 中的图片改为指向 .assets, 失败时保留完整的 mhtml
+        path = self.output.target(task, "mhtml")
+        try:
+            mhtml = await asyncio.to_thread(read_mhtml, path)
+            slim = await self.image_store.slim_mhtml_content(mhtml, path)
+            if slim != mhtml:
+                await self.output.write(task, "mhtml", slim)
+        except (OSError, ValueError) as e:
+            logger.warning(f"精简 mhtml 图片失败: {path}, 错误: {e}")
+
+    async def _print(self, mhtml_path: str, part_path: str) -> str:
+        page = await self._context.new_page()
+        try:
+            client = await page.context.new_cdp_session(page)
+            await page.goto(Path(os.path.abspath(mhtml_path)).as_uri(), wait_until="load", timeout=RENDER_LOAD_TIMEOUT * 1000)
+            return await asyncio.wait_for(print_to_pdf(client, part_path, self.print_options), RENDER_PRINT_TIMEOUT)
+        finally:
+            try:
+                await page.close()
+            except playwright._impl._errors.Error:
+                pass
+
+    async def close(self):
+        self._stop.set()
+        _, pending = await asyncio.wait(self._tasks, timeout=RENDER_PRINT_TIMEOUT) if self._tasks else (None, [])
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for obj in (self._context, self._browser):
+            if obj is not None:
+                try:
+                    await obj.close()
+                except Exception as e:
+                    logger.info(f"关闭打印浏览器异常: {e}")
+        if self._playwright_manager is not None:
+            await self._playwright_manager.stop()
+
+
+async def rerender(render_queue: SqliteTaskQueue, article_index: ArticleIndex, nickname: str = None) -> int:
+    """
+    为已保存 mhtml 的文章重新添加打印任务, 用于修改打印参数后重新生成 PDF
+    """
+    articles = article_index.with_format("mhtml", nickname)
+    ids = await render_queue.put_many(
+        [render_task(article) for article in articles],
+        [normalize_article_url(article["url"]) for article in articles],
+        accounts=[article["nickname"] for article in articles],
+    )
+    return sum(1 for task_id in ids if task_id is not None)
+
+
+async def run(settings: dict, args):
+    base = settings["base"]
+    data_dir = base.get("data_dir") or DATA_DIR
+    render_queue = SqliteTaskQueue(
+        os.path.join(data_dir, "render.db"),
+        lease_seconds=float(base.get("task_lease") or 600),
+        max_attempts=int(base.get("max_attempts") or 3),
+    )
+    article_index = ArticleIndex(os.path.join(data_dir, "articles.db"))
+    await render_queue.open()
+    await article_index.open()
+    await article_index.load()
+    try:
+        if args.rerender:
+            count = await rerender(render_queue, article_index, args.nickname)
+            logger.info(f"已添加 {count} 个重新打印任务")
+        # 服务进程中的打印 worker 可能正在打印, 不重置 running 的任务; 异常退出留下的任务在租约过期后重新领取
+        output = create_output(settings)
+        renderer = PdfRenderer.from_settings(settings, render_queue, article_index, output, args.workers)
+        await renderer.start()
+        heartbeat = asyncio.create_task(render_queue.heartbeat())
+        try:
+            while True:
+                await asyncio.sleep(1)
+                if args.exit_when_empty and not renderer.busy and not await render_queue.qsize():
+                    break
+        finally:
+            await renderer.close()
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+            await output.close()
+    finally:
+        await render_queue.close()
+        await article_index.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="从已保存的 mhtml 打印 PDF")
+    parser.add_argument("--rerender", action="store_true", help="为所有已保存 mhtml 的文章重新打印 PDF")
+    parser.add_argument("--nickname", help="只重新打印该公众号的文章")
+    parser.add_argument("--workers", type=int, help="打印 worker 数量, 默认使用 [pdf] renderers")
+    parser.add_argument("--exit-when-empty", action="store_true", help="队列为空时退出")
+    args = parser.parse_args()
+    logger.remove(handler_id=None)
+    logger.add(sys.stdout, level="INFO")
+    asyncio.run(run(read_ini_file(), args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import time
+import random
+import asyncio
+from urllib.parse import urlsplit, parse_qs
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float = 1):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.failures = 0
+
+    def wait_time(self, now: float) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def snapshot(self, now: float) -> dict:
+        return {
+            "rate": round(self.rate, 4),
+            "blocked_for": round(max(self.blocked_until - now, 0), 1),
+            "failures": self.failures,
+        }
+
+
+class AdaptiveRateLimiter:
+    """
+    按域名和公众号分别限速的令牌桶, 请求成功时缓慢提速, 遇到验证页面时减速并指数退避
+    """
+    def __init__(self, host_rate=0.2, account_rate=0.2, min_rate=0.02, max_rate=2.0,
+                 rate_step=0.02, backoff=60, max_backoff=1800):
+        self.host_rate = host_rate
+        self.account_rate = account_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate_step = rate_step
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._buckets: dict[str, TokenBucket] = {}
+
+    @classmethod
+    def from_settings(cls, settings: dict, share: int = 1):
+        """
+        多进程下载时每个进程有自己的限速器, share 为进程数, 速率平分后总速率不变
+        """
+        config = settings.get("ratelimit", {})
+        return cls(
+            host_rate=float(config.get("rate") or 0.2) / share,
+            account_rate=float(config.get("account_rate") or 0.2) / share,
+            min_rate=float(config.get("min_rate") or 0.02) / share,
+            max_rate=float(config.get("max_rate") or 2.0) / share,
+            backoff=float(config.get("backoff") or 60),
+            max_backoff=float(config.get("max_backoff") or 1800),
+        )
+
+    def _keys(self, url: str, account: str = None) -> list[str]:
+        parsed = urlsplit(url)
+        biz = parse_qs(parsed.query.replace("&amp;", "&")).get("__biz")
+        keys = [f"host:{parsed.hostname}"]
+        if biz or account:
+            keys.append(f"account:{biz[0] if biz else account}")
+        return keys
+
+    def _bucket(self, key: str) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            rate = self.host_rate if key.startswith("host:") else self.account_rate
+            bucket = self._buckets[key] = TokenBucket(rate)
+        return bucket
+
+    async def acquire(self, url: str, account: str = None):
+        buckets = [self._bucket(key) for key in self._keys(url, account)]
+        while True:
+            now = time.monotonic()
+            wait = max(bucket.wait_time(now) for bucket in buckets)
+            if wait <= 0:
+                for bucket in buckets:
+                    bucket.tokens -= 1
+                return
+            await asyncio.sleep(wait)
+
+    def success(self, url: str, account: str = None):
+        for key in self._keys(url, account):
+            bucket = self._bucket(key)
+            bucket.failures = 0
+            bucket.rate = min(self.max_rate, bucket.rate + self.rate_step)
+
+    def blocked(self, url: str, account: str = None) -> float:
+        """
+        遇到验证或封禁页面, 域名和公众号的速率都减半并暂停一段时间, 返回暂停的秒数;
+        验证页面按访问者而不是按公众号出现, 暂停期间同一域名下所有公众号的请求都会等待
+        """
+        now = time.monotonic()
+        delay = 0
+        for key in self._keys(url, account):
+            bucket = self._bucket(key)
+            bucket.failures += 1
+            bucket.rate = max(self.min_rate, bucket.rate / 2)
+            bucket_delay = min(self.max_backoff, self.backoff * 2 ** (bucket.failures - 1)) * random.uniform(0.75, 1.25)
+            bucket.blocked_until = max(bucket.blocked_until, now + bucket_delay)
+            delay = max(delay, bucket.blocked_until - now)
+        return delay
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        return {key: bucket.snapshot(now) for key, bucket in self._buckets.items()}
@@ -1,13 +1,22 @@
-import os
-import sys
-
-ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-
-DEBUG = not hasattr(sys.modules["__main__"], "__compiled__")
-
-if not DEBUG:
-    ROOT_DIR = os.path.dirname(os.path.abspath(sys.argv[0]))
-
-API_PORT = 23888
-
-CHROMIUM_EXECUTABLE_PATH = r"C:\Program Files (x86)\Microsoft\Edge\Application\msedge.exe"
\ No newline at end of file
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEBUG = not hasattr(sys.modules["__main__"], "__compiled__")
+
+if not DEBUG:
+    ROOT_DIR = os.path.dirname(os.path.abspath(sys.argv[0]))
+
+API_PORT = 23888
+
+# 配置文件路径, 可以用环境变量指定其他配置, 例如性能测试时的临时配置
+CONFIG_PATH = os.environ.get("DOWNLOAD_BIZ_CONFIG") or os.path.join(ROOT_DIR, "config.ini")
+
+# 任务队列等数据库文件的默认目录
+DATA_DIR = os.path.join(ROOT_DIR, "data")
+
+CHROMIUM_EXECUTABLE_PATH = r"C:\Program Files (x86)\Microsoft\Edge\Application\msedge.exe"
+
+# 关闭服务时等待正在下载的任务完成的最长时间(秒)
+WORKER_DRAIN_TIMEOUT = 30
@@ -0,0 +1,241 @@
+import os
+import re
+import time
+import asyncio
+import hashlib
+import sqlite3
+from urllib.parse import urlsplit, parse_qs
+from .base import SqliteStore, transaction
+from .output import WARC_INDEX_SUFFIX, read_warc_index
+
+
+ARTICLE_FORMATS = ("pdf", "mhtml", "html")
+WECHAT_KEY_PARAMS = ("__biz", "mid", "idx", "sn")
+
+_mhtml_url_re = re.compile(rb"Snapshot-Content-Location:\s*(\S+)")
+_html_url_res = (
+    re.compile(rb'<meta\s+property="og:url"\s+content="([^"]+)"'),
+    re.compile(rb'var\s+msg_link\s*=\s*"([^"]+)"'),
+)
+
+
+def normalize_article_url(url: str) -> str:
+    """
+    文章去重用的 key, 长链接使用 __biz/mid/idx/sn, 短链接使用域名和路径
+    """
+    url = url.strip().replace("&amp;", "&").replace("\\x26amp;", "&").replace("\\x26", "&")
+    parsed = urlsplit(url)
+    query = parse_qs(parsed.query)
+    if all(query.get(name) for name in WECHAT_KEY_PARAMS[:3]):
+        return "|".join(query.get(name, [""])[0] for name in WECHAT_KEY_PARAMS)
+    return f"{parsed.netloc.lower()}{parsed.path.rstrip('/')}"
+
+
+def _read_article_url(path: str, ext: str) -> str:
+    try:
+        with open(path, "rb") as f:
+            head = f.read(8192 if ext == "mhtml" else 262144)
+    except OSError:
+        return None
+    patterns = (_mhtml_url_re,) if ext == "mhtml" else _html_url_res
+    for pattern in patterns:
+        match = pattern.search(head)
+        if match:
+            return match.group(1).decode("utf-8", "ignore")
+    return None
+
+
+def _scan_warc_index(entry: os.DirEntry) -> list[tuple]:
+    nickname = entry.name[:-len(WARC_INDEX_SUFFIX)]
+    files: dict[str, tuple] = {}
+    for record in read_warc_index(entry.path)[0]:
+        url, formats = files.get(record["filename"], (record["url"], set()))
+        formats.add(record["format"])
+        files[record["filename"]] = (url, formats)
+    return [(url, nickname, filename, sorted(formats)) for filename, (url, formats) in files.items()]
+
+
+def scan_save_path(save_path: str) -> list[tuple]:
+    """
+    扫描保存目录, 从 mhtml 头部、html 或 WARC 索引中找回文章链接, 返回 (url, nickname, filename, formats)
+    """
+    articles = []
+    if not os.path.isdir(save_path):
+        return articles
+    for biz_entry in os.scandir(save_path):
+        if biz_entry.is_file() and biz_entry.name.endswith(WARC_INDEX_SUFFIX):
+            articles.extend(_scan_warc_index(biz_entry))
+            continue
+        if not biz_entry.is_dir() or biz_entry.name.startswith("."):
+            continue
+        files: dict[str, dict] = {}
+        for entry in os.scandir(biz_entry.path):
+            stem, _, ext = entry.name.rpartition(".")
+            if ext in ARTICLE_FORMATS and entry.is_file():
+                files.setdefault(stem, {})[ext] = entry.path
+        for stem, paths in files.items():
+            url = None
+            for ext in ("mhtml", "html"):
+                if ext in paths:
+                    url = _read_article_url(paths[ext], ext)
+                    if url:
+                        break
+            if url:
+                articles.append((url, biz_entry.name, stem, sorted(paths)))
+    return articles
+
+
+class ArticleIndex(SqliteStore):
+    """
+    已下载文章索引, 全部加载到内存中, 入队前即可判断文章是否已经下载
+    """
+    schema = """
+    CREATE TABLE IF NOT EXISTS articles (
+        key TEXT PRIMARY KEY,
+        url TEXT NOT NULL,
+        nickname TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        formats TEXT NOT NULL DEFAULT '',
+        updated_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_articles_updated ON articles (updated_at);
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self._articles: dict[str, dict] = {}
+        self._names: dict[tuple, str] = {}
+        self._loaded_at = 0
+
+    def __len__(self):
+        return len(self._articles)
+
+    def _add(self, key: str, url: str, nickname: str, filename: str, formats):
+        article = self._articles.get(key)
+        if article is None:
+            article = self._articles[key] = {"url": url, "nickname": nickname, "filename": filename, "formats": set()}
+            self._names[(nickname, filename)] = key
+        article["formats"].update(formats)
+        return article
+
+    def _load(self, conn: sqlite3.Connection, since: float = None) -> list:
+        if since is None:
+            return conn.execute("SELECT key, url, nickname, filename, formats, updated_at FROM articles").fetchall()
+        return conn.execute(
+            "SELECT key, url, nickname, filename, formats, updated_at FROM articles WHERE updated_at > ?", (since,)
+        ).fetchall()
+
+    def _upsert(self, conn: sqlite3.Connection, rows: list[tuple]) -> dict[str, set]:
+        # 其他进程(打印 worker、其他下载进程)可能已经写入了本进程内存中没有的格式,
+        # 在同一个写事务中读出已保存的格式取并集, 不会互相覆盖
+        now = time.time()
+        merged: dict[str, set] = {}
+        with transaction(conn):
+            for key, url, nickname, filename, formats in rows:
+                row = conn.execute("SELECT formats FROM articles WHERE key = ?", (key,)).fetchone()
+                formats = set(filter(None, formats.split(",")))
+                if row is not None:
+                    formats.update(filter(None, row["formats"].split(",")))
+                merged[key] = formats
+                conn.execute(
+                    "INSERT INTO articles (key, url, nickname, filename, formats, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET formats = excluded.formats, updated_at = excluded.updated_at",
+                    (key, url, nickname, filename, ",".join(sorted(formats)), now)
+                )
+        return merged
+
+    def _replace(self, conn: sqlite3.Connection, rows: list[tuple]):
+        # 重建时以扫描结果为准, 不与已有记录合并
+        now = time.time()
+        with transaction(conn):
+            conn.execute("DELETE FROM articles")
+            conn.executemany(
+                "INSERT INTO articles (key, url, nickname, filename, formats, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                [(*row, now) for row in rows]
+            )
+
+    def _get(self, conn: sqlite3.Connection, key: str) -> sqlite3.Row:
+        return conn.execute("SELECT key, url, nickname, filename, formats FROM articles WHERE key = ?", (key,)).fetchone()
+
+    async def load(self, since: float = None) -> int:
+        rows = await self._run(self._load, since)
+        for row in rows:
+            self._add(row["key"], row["url"], row["nickname"], row["filename"], filter(None, row["formats"].split(",")))
+            self._loaded_at = max(self._loaded_at, row["updated_at"])
+        return len(rows)
+
+    async def refresh(self, window: float = 5) -> int:
+        """
+        读取其他进程(下载进程、单独运行的打印 worker)新保存的文章, 多读 window 秒避免漏掉提交较晚的记录
+        """
+        return await self.load(self._loaded_at - window)
+
+    async def watch(self, interval: float = 2):
+        while True:
+            await asyncio.sleep(interval)
+            await self.refresh()
+
+    def get(self, url: str) -> dict:
+        return self._articles.get(normalize_article_url(url))
+
+    async def reload(self, url: str) -> dict:
+        """
+        从数据库重新读取单篇文章, 合并其他进程保存的格式, 判断需要下载的格式前调用
+        """
+        row = await self._run(self._get, normalize_article_url(url))
+        if row is None:
+            return self.get(url)
+        return self._add(row["key"], row["url"], row["nickname"], row["filename"], filter(None, row["formats"].split(",")))
+
+    def missing_formats(self, url: str, formats: list[str]) -> list[str]:
+        article = self.get(url)
+        if article is None:
+            return list(formats)
+        return [fmt for fmt in formats if fmt not in article["formats"]]
+
+    def is_downloaded(self, url: str, formats: list[str]) -> bool:
+        return not self.missing_formats(url, formats)
+
+    def with_format(self, fmt: str, nickname: str = None) -> list[dict]:
+        return [
+            article for article in self._articles.values()
+            if fmt in article["formats"] and (not nickname or article["nickname"] == nickname)
+        ]
+
+    def assign_filename(self, url: str, nickname: str, filename: str) -> str:
+        """
+        为文章分配文件名, 标题截断后重名的文章追加链接哈希, 不再被误判为已下载
+        """
+        key = normalize_article_url(url)
+        article = self._articles.get(key)
+        if article is not None:
+            return article["filename"]
+        owner = self._names.get((nickname, filename))
+        if owner is not None and owner != key:
+            filename = f"{filename}_{hashlib.md5(key.encode('utf-8')).hexdigest()[:8]}"
+        self._names[(nickname, filename)] = key
+        return filename
+
+    async def record(self, url: str, nickname: str, filename: str, formats: list[str]):
+        if not formats:
+            return
+        key = normalize_article_url(url)
+        article = self._add(key, url, nickname, filename, formats)
+        merged = await self._run(self._upsert, [(key, url, nickname, article["filename"], ",".join(sorted(article["formats"])))])
+        article["formats"].update(merged[key])
+
+    async def rebuild(self, save_path: str) -> int:
+        """
+        从保存目录重建索引, 已经删除的文章和格式一并从索引中删除
+        """
+        scanned = await self._run(lambda conn: scan_save_path(save_path))
+        self._articles.clear()
+        self._names.clear()
+        for url, nickname, filename, formats in scanned:
+            self._add(normalize_article_url(url), url, nickname, filename, formats)
+        rows = [
+            (key, article["url"], article["nickname"], article["filename"], ",".join(sorted(article["formats"])))
+            for key, article in self._articles.items()
+        ]
+        await self._run(self._replace, rows)
+        return len(rows)
@@ -0,0 +1,69 @@
+import os
+import asyncio
+import sqlite3
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+
+@contextmanager
+def transaction(conn: sqlite3.Connection):
+    # IMMEDIATE 事务在开始时就拿到写锁, 多个进程同时领取任务时不会出现死锁
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def ensure_columns(conn: sqlite3.Connection, table: str, columns: dict[str, str]):
+    # 旧版本创建的数据库缺少新增的列, 启动时补上
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    for name, declaration in columns.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {declaration}")
+
+
+class SqliteStore:
+    """
+    SQLite 存储基类, 所有数据库操作都在同一个后台线程中执行, 不阻塞事件循环
+    """
+    schema = ""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: sqlite3.Connection = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=self.__class__.__name__)
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        if self.schema:
+            conn.executescript(self.schema)
+        return conn
+
+    def _call(self, func, args):
+        if self._conn is None:
+            self._conn = self._connect()
+        return func(self._conn, *args)
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, func, args)
+
+    async def open(self):
+        await self._run(lambda conn: None)
+        return self
+
+    def _close(self, conn: sqlite3.Connection):
+        conn.close()
+        self._conn = None
+
+    async def close(self):
+        if self._conn is not None:
+            await self._run(self._close)
+        self._executor.shutdown(wait=False)
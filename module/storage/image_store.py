@@ -0,0 +1,274 @@
+import os
+import re
+import html
+import email
+import base64
+import asyncio
+import hashlib
+import tempfile
+import binascii
+import mimetypes
+from email import policy
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit, parse_qs
+from loguru import logger
+
+
+# 图片保存在 save_path 下的隐藏目录, 重建文章索引时会跳过
+ASSET_DIR_NAME = ".assets"
+IMAGE_EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+    "image/svg+xml": ".svg",
+    "image/bmp": ".bmp",
+    "image/x-icon": ".ico",
+}
+_image_url_re = re.compile(r'''(\bsrc=|url\()(["']?)((?:https?:)?//[^"'()\s>]+)\2''', re.I)
+_boundary_re = re.compile(r'''boundary=(?:"([^"]+)"|([^;\s]+))''', re.I)
+_external_name_re = re.compile(r'''name="([^"]+)"''', re.I)
+# 精简后的 mhtml 中, 图片部分改为指向 .assets 中文件的 message/external-body
+EXTERNAL_BODY_TYPE = "message/external-body"
+BASE64_LINE_LENGTH = 76
+
+
+def extract_mhtml_images(mhtml: str) -> dict[str, tuple[bytes, str]]:
+    """
+    解析 mhtml 中的图片部分, 返回 {图片链接: (内容, 类型)}
+    """
+    images = {}
+    message = email.message_from_string(mhtml, policy=policy.compat32)
+    for part in message.walk():
+        content_type = part.get_content_type()
+        location = part.get("Content-Location")
+        if not content_type.startswith("image/") or not location:
+            continue
+        body = part.get_payload(decode=True)
+        if body:
+            images[location.strip()] = (body, content_type)
+    return images
+
+
+def _split_part(part: str) -> tuple[str, list[str], str]:
+    """
+    把 mhtml 的一个部分拆成 (换行符, 头部行, 正文), 折行的头部合并到同一项
+    """
+    newline = "\r\n" if part.startswith("\r\n") else "\n"
+    head, _, body = part[len(newline):].partition(newline * 2)
+    headers = []
+    for line in head.split(newline):
+        if headers and line[:1] in (" ", "\t"):
+            headers[-1] += newline + line
+        else:
+            headers.append(line)
+    return newline, headers, body
+
+
+def _header(headers: list[str], name: str) -> str:
+    prefix = f"{name.lower()}:"
+    for line in headers:
+        if line.lower().startswith(prefix):
+            return line[len(prefix):].strip()
+    return ""
+
+
+def _without(headers: list[str], *names: str) -> list[str]:
+    prefixes = tuple(f"{name.lower()}:" for name in names)
+    return [line for line in headers if not line.lower().startswith(prefixes)]
+
+
+def _map_mhtml_parts(mhtml: str, func) -> str:
+    """
+    逐个替换 mhtml 的各个部分, 未修改的部分原样保留
+    """
+    head_end = mhtml.find("\r\n\r\n")
+    match = _boundary_re.search(mhtml[:head_end if head_end > 0 else 4096])
+    if match is None:
+        return mhtml
+    delimiter = f"--{match.group(1) or match.group(2)}"
+    pieces = mhtml.split(delimiter)
+    for index in range(1, len(pieces)):
+        # 结束分隔符后面是 --, 不是图片部分
+        if not pieces[index].startswith("--"):
+            pieces[index] = func(pieces[index])
+    return delimiter.join(pieces)
+
+
+def restore_mhtml(mhtml: str, mhtml_path: str) -> str:
+    """
+    把精简后的 mhtml 中指向 .assets 的图片还原为内嵌的图片, 用于打印 PDF 或离线查看
+    """
+    base_dir = os.path.dirname(os.path.abspath(mhtml_path))
+
+    def restore(part: str) -> str:
+        newline, headers, body = _split_part(part)
+        content_type = _header(headers, "Content-Type")
+        if not content_type.lower().startswith(EXTERNAL_BODY_TYPE):
+            return part
+        name = _external_name_re.search(content_type)
+        try:
+            with open(os.path.join(base_dir, name.group(1)), "rb") as f:
+                data = base64.b64encode(f.read()).decode("ascii")
+        except (AttributeError, OSError) as e:
+            logger.warning(f"还原 mhtml 图片失败, 保留外部引用: {mhtml_path}, 错误: {e}")
+            return part
+        _, headers, _ = _split_part(newline + body)
+        lines = [data[i:i + BASE64_LINE_LENGTH] for i in range(0, len(data), BASE64_LINE_LENGTH)]
+        return newline + newline.join(headers) + newline * 2 + newline.join(lines) + newline
+
+    return _map_mhtml_parts(mhtml, restore)
+
+
+def read_mhtml(path: str) -> str:
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        return f.read()
+
+
+def is_slim_mhtml(mhtml: str) -> bool:
+    return f"Content-Type: {EXTERNAL_BODY_TYPE}" in mhtml
+
+
+@asynccontextmanager
+async def full_mhtml(mhtml_path: str):
+    """
+    提供一个图片都内嵌的 mhtml 文件路径, 精简过的 mhtml 还原到临时文件
+    """
+    mhtml = await asyncio.to_thread(read_mhtml, mhtml_path)
+    if not is_slim_mhtml(mhtml):
+        yield mhtml_path
+        return
+    content = await asyncio.to_thread(restore_mhtml, mhtml, mhtml_path)
+    fd, path = tempfile.mkstemp(suffix=".mhtml")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+            f.write(content)
+        yield path
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _image_url(value: str) -> str:
+    url = html.unescape(value)
+    return f"https:{url}" if url.startswith("//") else url
+
+
+def image_extension(url: str, content_type: str) -> str:
+    ext = IMAGE_EXTENSIONS.get((content_type or "").split(";")[0].strip().lower())
+    if ext:
+        return ext
+    # 微信图片链接没有后缀, 格式在 wx_fmt 参数中
+    wx_fmt = parse_qs(urlsplit(url).query).get("wx_fmt")
+    if wx_fmt:
+        return IMAGE_EXTENSIONS.get(f"image/{wx_fmt[0].lower().replace('jpg', 'jpeg')}", ".img")
+    return mimetypes.guess_extension(content_type or "") or ".img"
+
+
+class ImageStore:
+    """
+    按内容哈希保存文章图片, 同一个保存目录下相同的图片只保存一份
+    """
+    def __init__(self, save_path: str, slim_mhtml: bool = False):
+        self.root = os.path.join(save_path, ASSET_DIR_NAME)
+        self.slim_mhtml = slim_mhtml
+        self.stored = 0
+        self.reused = 0
+
+    @classmethod
+    def from_settings(cls, settings: dict, output):
+        base = settings["base"]
+        if base.get("dedupe_images", "false") != "true":
+            return None
+        if output.name != "files":
+            logger.warning("dedupe_images 只支持 output = files, 已忽略")
+            return None
+        return cls(base["save_path"], base.get("slim_mhtml", "false") == "true")
+
+    def path_for(self, digest: str, ext: str) -> str:
+        return os.path.join(self.root, digest[:2], f"{digest}{ext}")
+
+    def put(self, url: str, body: bytes, content_type: str) -> str:
+        """
+        保存图片并返回文件路径, 已有相同内容时直接返回
+        """
+        digest = hashlib.sha256(body).hexdigest()
+        path = self.path_for(digest, image_extension(url, content_type))
+        if os.path.exists(path):
+            self.reused += 1
+            return path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part_path = f"{path}.{os.getpid()}.part"
+        with open(part_path, "wb") as f:
+            f.write(body)
+        os.replace(part_path, path)
+        self.stored += 1
+        return path
+
+    def localize(self, content: str, html_path: str, images: dict[str, tuple[bytes, str]]) -> str:
+        """
+        把 html 中已有内容的图片链接替换为本地文件的相对路径, 没有内容的图片保留原链接
+        """
+        base_dir = os.path.dirname(html_path)
+        local_paths = {}
+
+        def replace(match: re.Match) -> str:
+            url = _image_url(match.group(3))
+            if url not in local_paths:
+                image = images.get(url)
+                local_paths[url] = None if image is None else os.path.relpath(self.put(url, *image), base_dir).replace(os.sep, "/")
+            local_path = local_paths[url]
+            if local_path is None:
+                return match.group(0)
+            return f"{match.group(1)}{match.group(2)}{local_path}{match.group(2)}"
+
+        return _image_url_re.sub(replace, content)
+
+    def slim(self, mhtml: str, mhtml_path: str) -> str:
+        """
+        把 mhtml 中的图片保存到 .assets, 原位置改为指向该文件的 message/external-body, 相同图片只保存一份
+        """
+        base_dir = os.path.dirname(os.path.abspath(mhtml_path))
+
+        def slim_part(part: str) -> str:
+            newline, headers, body = _split_part(part)
+            content_type = _header(headers, "Content-Type")
+            if not content_type.lower().startswith("image/") or _header(headers, "Content-Transfer-Encoding").lower() != "base64":
+                return part
+            try:
+                data = base64.b64decode("".join(body.split()), validate=True)
+            except (binascii.Error, ValueError):
+                return part
+            if not data:
+                return part
+            local_path = os.path.relpath(self.put(_header(headers, "Content-Location"), data, content_type), base_dir)
+            outer = [
+                f'Content-Type: {EXTERNAL_BODY_TYPE}; access-type=local-file; name="{local_path.replace(os.sep, "/")}"',
+                *_without(headers, "Content-Type", "Content-Transfer-Encoding"),
+            ]
+            # external-body 的正文是原来的头部, 还原时原样使用
+            return newline + newline.join(outer) + newline * 2 + newline.join(headers) + newline * 2
+
+        return _map_mhtml_parts(mhtml, slim_part)
+
+    async def slim_mhtml_content(self, mhtml: str, mhtml_path: str) -> str:
+        return await asyncio.to_thread(self.slim, mhtml, mhtml_path)
+
+    async def localize_html(self, content: str, html_path: str, mhtml: str = None, asset_cache=None) -> str:
+        """
+        图片内容优先从同一篇文章的 mhtml 中取, 其次从浏览器的资源缓存中取
+        """
+        images = await asyncio.to_thread(extract_mhtml_images, mhtml) if mhtml else {}
+        if asset_cache is not None:
+            for match in _image_url_re.finditer(content):
+                url = _image_url(match.group(3))
+                if url in images:
+                    continue
+                cached = await asset_cache.get(url)
+                if cached is not None and (cached[1] or "").startswith("image/"):
+                    images[url] = cached
+        if not images:
+            return content
+        return await asyncio.to_thread(self.localize, content, html_path, images)
@@ -0,0 +1,379 @@
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import asyncio
+import tempfile
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from loguru import logger
+
+if sys.platform == "win32":
+    import msvcrt
+else:
+    import fcntl
+
+
+WARC_SUFFIX = ".warc"
+WARC_INDEX_SUFFIX = ".warc.idx"
+WARC_CONTENT_TYPES = {
+    "pdf": "application/pdf",
+    "mhtml": "multipart/related",
+    "html": "text/html; charset=utf-8",
+}
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def _content_bytes(content) -> bytes:
+    if isinstance(content, bytes):
+        return content
+    if isinstance(content, str):
+        return content.encode("utf-8")
+    # 逐块生成的文本
+    return b"".join(chunk.encode("utf-8") for chunk in content)
+
+
+class FileOutput:
+    """
+    默认的保存方式, 每篇文章的每种格式保存为 save_path/<公众号>/<文件名>.<格式>
+    """
+    name = "files"
+
+    def __init__(self, save_path: str):
+        self.save_path = save_path
+
+    def path(self, article: dict, fmt: str) -> str:
+        return os.path.join(self.save_path, article["nickname"], f"{article['filename']}.{fmt}")
+
+    def target(self, article: dict, fmt: str) -> str:
+        return self.path(article, fmt)
+
+    def part_path(self, article: dict, fmt: str) -> str:
+        """
+        边获取边写入的临时文件路径, 写完后交给 write 保存
+        """
+        path = self.path(article, fmt)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return f"{path}.part"
+
+    async def write(self, article: dict, fmt: str, content) -> int:
+        """
+        保存一种格式, content 为文本、逐块生成文本的迭代器或 part_path 返回的临时文件, 返回写入的字节数
+        """
+        path = self.path(article, fmt)
+        await asyncio.to_thread(os.makedirs, os.path.dirname(path), exist_ok=True)
+        if fmt == "pdf":
+            # PDF 在获取时已经写入临时文件, 这里只需要重命名
+            await asyncio.to_thread(os.replace, content, path)
+        else:
+            await asyncio.to_thread(self._write_text, path, fmt, content)
+        self._set_file_times(path, article.get("pub_time"))
+        return os.path.getsize(path)
+
+    def _write_text(self, path: str, fmt: str, content: str):
+        part_path = f"{path}.part"
+        if fmt == "mhtml":
+            # 与 WARC 记录使用相同的编码, 两种保存方式得到的文件内容一致
+            with open(part_path, "w", encoding="utf-8", newline="") as f:
+                f.write(content)
+        else:
+            with open(part_path, "w", encoding="utf-8") as f:
+                if isinstance(content, str):
+                    f.write(content)
+                else:
+                    f.writelines(content)
+        os.replace(part_path, path)
+
+    def _set_file_times(self, path, pub_time):
+        if not pub_time:
+            return
+        pub_timestamp = int(time.mktime(time.strptime(pub_time, "%Y-%m-%d %H:%M:%S")))
+        try:
+            os.utime(path, (pub_timestamp, pub_timestamp))
+        except Exception as e:
+            logger.warning(f"设置文件时间失败: {path}, 错误: {e}")
+
+    @asynccontextmanager
+    async def local_file(self, article: dict, fmt: str):
+        """
+        提供一个可以直接打开的本地文件路径, 不存在时为 None
+        """
+        path = self.path(article, fmt)
+        yield path if os.path.exists(path) else None
+
+    async def close(self):
+        pass
+
+
+@contextmanager
+def _file_lock(path: str):
+    # 多个进程可能同时写同一个公众号的 WARC, 用锁文件串行化追加
+    with open(path, "a+b") as f:
+        if sys.platform == "win32":
+            while True:
+                try:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def read_warc_index(path: str, start: int = 0) -> tuple[list[dict], int]:
+    """
+    读取 .warc.idx 中 start 之后的完整行, 返回 (记录, 读到的位置), 末尾不完整的行不计入
+    """
+    entries = []
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read()
+    end = data.rfind(b"\n") + 1
+    for line in data[:end].splitlines():
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            continue
+    return entries, start + end
+
+
+class _WarcArchive:
+    """
+    单个公众号的 WARC 文件和索引, 所有修改都在锁内进行
+    """
+    def __init__(self, warc_path: str):
+        self.warc_path = warc_path
+        self.index_path = warc_path[:-len(WARC_SUFFIX)] + WARC_INDEX_SUFFIX
+        self.lock_path = f"{warc_path}.lock"
+        self.entries: dict[tuple, dict] = {}
+        self.index_size = 0
+        self.end = 0
+        self.thread_lock = threading.Lock()
+
+    def _refresh(self):
+        # 其他进程追加的记录或上次启动的记录, 从上次读到的位置继续读
+        if not os.path.exists(self.index_path):
+            if not os.path.exists(self.warc_path) or not os.path.getsize(self.warc_path):
+                return
+            self._rebuild_index()
+        entries, self.index_size = read_warc_index(self.index_path, self.index_size)
+        for entry in entries:
+            self.entries[(entry["filename"], entry["format"])] = entry
+            self.end = max(self.end, entry["offset"] + entry["length"])
+
+    def _rebuild_index(self):
+        """
+        索引文件丢失时从 WARC 记录头重建, 遇到不完整的记录停止
+        """
+        lines = []
+        with open(self.warc_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            while True:
+                offset = f.tell()
+                headers = {}
+                line = f.readline()
+                if not line.startswith(b"WARC/"):
+                    break
+                while True:
+                    line = f.readline()
+                    if not line.endswith(b"\r\n"):
+                        headers = None
+                        break
+                    if line == b"\r\n":
+                        break
+                    name, _, value = line.decode("utf-8").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                if not headers or "article-filename" not in headers:
+                    break
+                body_offset = f.tell()
+                body_length = int(headers.get("content-length", 0))
+                if body_offset + body_length + 4 > size:
+                    break
+                f.seek(body_length + 4, os.SEEK_CUR)
+                lines.append({
+                    "url": headers.get("warc-target-uri"),
+                    "filename": headers["article-filename"],
+                    "format": headers.get("article-format"),
+                    "offset": offset,
+                    "length": f.tell() - offset,
+                    "body_offset": body_offset,
+                    "body_length": body_length,
+                    "pub_time": headers.get("article-pub-time"),
+                })
+        with open(self.index_path, "wb") as f:
+            f.write("".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in lines).encode("utf-8"))
+        logger.info(f"已从 WARC 文件重建索引, 共 {len(lines)} 条记录: {self.warc_path}")
+
+    def _recover(self):
+        """
+        截掉没有写入索引的记录和不完整的索引行, 它们来自写到一半时崩溃的进程
+        """
+        if os.path.exists(self.index_path) and os.path.getsize(self.index_path) > self.index_size:
+            with open(self.index_path, "r+b") as f:
+                f.truncate(self.index_size)
+        if os.path.exists(self.warc_path) and os.path.getsize(self.warc_path) > self.end:
+            logger.warning(f"WARC 文件末尾有未完成的记录, 已截断: {self.warc_path}")
+            with open(self.warc_path, "r+b") as f:
+                f.truncate(self.end)
+
+    def append(self, url: str, filename: str, fmt: str, pub_time: str, body) -> dict:
+        with self.thread_lock, _file_lock(self.lock_path):
+            self._refresh()
+            self._recover()
+            if isinstance(body, str) and fmt == "pdf":
+                body_length = os.path.getsize(body)
+            else:
+                body = _content_bytes(body)
+                body_length = len(body)
+            header = "\r\n".join([
+                "WARC/1.1",
+                "WARC-Type: resource",
+                f"WARC-Record-ID: <urn:uuid:{uuid.uuid4()}>",
+                f"WARC-Date: {time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}",
+                f"WARC-Target-URI: {url}",
+                f"Content-Type: {WARC_CONTENT_TYPES.get(fmt, 'application/octet-stream')}",
+                f"Content-Length: {body_length}",
+                # 自定义字段, 索引丢失时可以从 WARC 重建
+                f"Article-Filename: {filename}",
+                f"Article-Format: {fmt}",
+                *([f"Article-Pub-Time: {pub_time}"] if pub_time else []),
+                "", "",
+            ]).encode("utf-8")
+            with open(self.warc_path, "ab") as f:
+                offset = f.tell()
+                f.write(header)
+                if isinstance(body, bytes):
+                    f.write(body)
+                else:
+                    with open(body, "rb") as src:
+                        shutil.copyfileobj(src, f, COPY_CHUNK_SIZE)
+                f.write(b"\r\n\r\n")
+                f.flush()
+                os.fsync(f.fileno())
+            entry = {
+                "url": url,
+                "filename": filename,
+                "format": fmt,
+                "offset": offset,
+                "length": len(header) + body_length + 4,
+                "body_offset": offset + len(header),
+                "body_length": body_length,
+                "pub_time": pub_time,
+            }
+            # 记录完整写入后才写索引, 索引中的记录一定是完整的
+            line = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+            with open(self.index_path, "ab") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self.index_size += len(line)
+            self.end = entry["offset"] + entry["length"]
+            self.entries[(filename, fmt)] = entry
+            return entry
+
+    def find(self, filename: str, fmt: str) -> dict:
+        with self.thread_lock:
+            entry = self.entries.get((filename, fmt))
+            if entry is None:
+                self._refresh()
+                entry = self.entries.get((filename, fmt))
+            return entry
+
+    def read_into(self, entry: dict, dst):
+        with open(self.warc_path, "rb") as f:
+            f.seek(entry["body_offset"])
+            remaining = entry["body_length"]
+            while remaining:
+                chunk = f.read(min(remaining, COPY_CHUNK_SIZE))
+                if not chunk:
+                    raise EOFError(f"WARC 记录不完整: {self.warc_path}")
+                dst.write(chunk)
+                remaining -= len(chunk)
+
+
+class WarcOutput:
+    """
+    每个公众号保存为一个只追加的 save_path/<公众号>.warc, 旁边的 .warc.idx 记录每篇文章每种格式的位置
+    """
+    name = "warc"
+
+    def __init__(self, save_path: str):
+        self.save_path = save_path
+        self._archives: dict[str, _WarcArchive] = {}
+
+    def archive(self, nickname: str) -> _WarcArchive:
+        archive = self._archives.get(nickname)
+        if archive is None:
+            archive = self._archives[nickname] = _WarcArchive(os.path.join(self.save_path, f"{nickname}{WARC_SUFFIX}"))
+        return archive
+
+    def target(self, article: dict, fmt: str) -> str:
+        return f"{self.archive(article['nickname']).warc_path}#{article['filename']}.{fmt}"
+
+    def part_path(self, article: dict, fmt: str) -> str:
+        os.makedirs(self.save_path, exist_ok=True)
+        return os.path.join(self.save_path, f".{article['nickname']}.{article['filename']}.{fmt}.part")
+
+    async def write(self, article: dict, fmt: str, content) -> int:
+        archive = self.archive(article["nickname"])
+        await asyncio.to_thread(os.makedirs, self.save_path, exist_ok=True)
+        entry = await asyncio.to_thread(archive.append, article["url"], article["filename"], fmt, article.get("pub_time"), content)
+        if fmt == "pdf":
+            await asyncio.to_thread(os.remove, content)
+        return entry["body_length"]
+
+    async def read(self, nickname: str, filename: str, fmt: str) -> bytes:
+        """
+        按文章读取某种格式的内容, 不存在时返回 None
+        """
+        archive = self.archive(nickname)
+        entry = await asyncio.to_thread(archive.find, filename, fmt)
+        if entry is None:
+            return None
+        buffer = io.BytesIO()
+        await asyncio.to_thread(archive.read_into, entry, buffer)
+        return buffer.getvalue()
+
+    @asynccontextmanager
+    async def local_file(self, article: dict, fmt: str):
+        archive = self.archive(article["nickname"])
+        entry = await asyncio.to_thread(archive.find, article["filename"], fmt)
+        if entry is None:
+            yield None
+            return
+        fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                await asyncio.to_thread(archive.read_into, entry, f)
+            yield path
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    async def close(self):
+        self._archives.clear()
+
+
+def create_output(settings: dict):
+    base = settings["base"]
+    output = base.get("output", "files")
+    if output == "warc":
+        return WarcOutput(base["save_path"])
+    if output != "files":
+        raise ValueError(f"不支持的保存方式: {output}")
+    return FileOutput(base["save_path"])
@@ -0,0 +1,359 @@
+"""
+已下载文章的全文索引, 使用 SQLite FTS5 的 trigram 分词, 中文不需要额外的分词库
+
+下载时保存 html 或 mhtml 后自动加入索引; 开启前已经下载的文章可以批量重建:
+    python -m module.storage.search_index --workers 4
+"""
+import os
+import re
+import sys
+import html
+import time
+import email
+import asyncio
+import sqlite3
+import argparse
+from email import policy
+from concurrent.futures import ProcessPoolExecutor
+from loguru import logger
+from .base import SqliteStore, transaction
+from .article_index import ArticleIndex, normalize_article_url
+from .output import FileOutput, WarcOutput, create_output
+from ..settings import DATA_DIR
+from ..tools import read_ini_file
+
+
+# trigram 分词只能匹配至少 3 个字的词, 更短的词用 LIKE 逐篇查找
+MIN_MATCH_LENGTH = 3
+# 标题的权重, 标题中出现关键词的文章排在前面
+TITLE_WEIGHT = 10.0
+SNIPPET_TOKENS = 32
+# 批量重建时每批交给进程池解析的文章数量, 解析完一批写入一次数据库
+REINDEX_BATCH_SIZE = 200
+
+_title_res = (
+    re.compile(r'<meta\s+property="og:title"\s+content="([^"]*)"', re.I),
+    re.compile(r'<h1\b[^>]*\bid="activity-name"[^>]*>(.*?)</h1>', re.I | re.S),
+    re.compile(r'<title\b[^>]*>(.*?)</title>', re.I | re.S),
+)
+_js_content_re = re.compile(r'<div\b[^>]*\bid=["\']js_content["\'][^>]*>', re.I)
+_div_tag_re = re.compile(r'<(/?)div\b[^>]*>', re.I)
+_hidden_re = re.compile(r'<(script|style|noscript|svg)\b.*?</\1\s*>', re.I | re.S)
+# 块级元素之间加空格, 行内元素直接拼接, 否则被 span 拆开的中文会在索引中断开
+_block_tag_re = re.compile(r'<(?:br|/?p|/?div|/?section|/?h[1-6]|/?li|/?tr|/?td|/?blockquote|/?figure|img)\b[^>]*>', re.I)
+_tag_re = re.compile(r'<[^>]*>')
+_space_re = re.compile(r'\s+')
+
+
+def html_to_text(fragment: str) -> str:
+    fragment = _hidden_re.sub(" ", fragment)
+    fragment = _block_tag_re.sub(" ", fragment)
+    fragment = _tag_re.sub("", fragment)
+    return _space_re.sub(" ", html.unescape(fragment)).strip()
+
+
+def _js_content(content: str) -> str:
+    """
+    正文容器 #js_content 的内容, 按 div 的嵌套层数找到对应的结束标签
+    """
+    match = _js_content_re.search(content)
+    if match is None:
+        return None
+    depth = 1
+    for tag in _div_tag_re.finditer(content, match.end()):
+        depth += -1 if tag.group(1) else 1
+        if not depth:
+            return content[match.end():tag.start()]
+    return content[match.end():]
+
+
+def extract_article_text(content: str) -> dict:
+    """
+    从文章页面中提取标题和正文文本, 没有 #js_content 时使用整个 body
+    """
+    title = ""
+    for pattern in _title_res:
+        match = pattern.search(content)
+        if match:
+            title = html_to_text(match.group(1))
+            if title:
+                break
+    body = _js_content(content)
+    if body is None:
+        start = content.lower().find("<body")
+        body = content[start:] if start >= 0 else content
+    return {"title": title, "content": html_to_text(body)}
+
+
+def mhtml_to_html(mhtml) -> str:
+    """
+    mhtml 中的主页面
+    """
+    if isinstance(mhtml, bytes):
+        message = email.message_from_bytes(mhtml, policy=policy.compat32)
+    else:
+        message = email.message_from_string(mhtml, policy=policy.compat32)
+    for part in message.walk():
+        if part.get_content_type() == "text/html":
+            payload = part.get_payload(decode=True) or b""
+            return payload.decode(part.get_content_charset() or "utf-8", "replace")
+    return ""
+
+
+def article_document(article: dict, content, fmt: str) -> dict:
+    """
+    生成一条索引记录, 页面中没有文字时返回 None
+    """
+    if fmt == "mhtml":
+        content = mhtml_to_html(content)
+    elif isinstance(content, bytes):
+        content = content.decode("utf-8", "replace")
+    text = extract_article_text(content)
+    if not text["content"] and not text["title"]:
+        return None
+    return {
+        "key": normalize_article_url(article["url"]),
+        "url": article["url"],
+        "nickname": article["nickname"],
+        "filename": article["filename"],
+        "title": text["title"] or article.get("title") or article["filename"],
+        "pub_time": article.get("pub_time"),
+        "content": text["content"],
+    }
+
+
+def _like_pattern(term: str) -> str:
+    return "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def _time_bound(value: str, end: bool) -> str:
+    # 只有日期时, 结束时间包含当天
+    if value and end and len(value) == 10:
+        return f"{value} 23:59:59"
+    return value
+
+
+class SearchIndex(SqliteStore):
+    """
+    文章全文索引, documents 保存文章信息, documents_fts 保存标题和正文, 两表的 rowid 相同
+    """
+    schema = """
+    CREATE TABLE IF NOT EXISTS documents (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        key TEXT NOT NULL UNIQUE,
+        url TEXT NOT NULL,
+        nickname TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        title TEXT NOT NULL DEFAULT '',
+        pub_time TEXT,
+        updated_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_documents_nickname ON documents(nickname, pub_time);
+    CREATE INDEX IF NOT EXISTS idx_documents_pub_time ON documents(pub_time);
+    CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(title, content, tokenize='trigram');
+    """
+
+    def _upsert(self, conn: sqlite3.Connection, documents: list[dict]):
+        now = time.time()
+        with transaction(conn):
+            for document in documents:
+                row = conn.execute(
+                    "INSERT INTO documents (key, url, nickname, filename, title, pub_time, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(key) DO UPDATE SET "
+                    "url = excluded.url, nickname = excluded.nickname, filename = excluded.filename, "
+                    "title = excluded.title, pub_time = COALESCE(excluded.pub_time, pub_time), updated_at = excluded.updated_at "
+                    "RETURNING id",
+                    (document["key"], document["url"], document["nickname"], document["filename"],
+                     document["title"], document["pub_time"], now)
+                ).fetchone()
+                conn.execute("DELETE FROM documents_fts WHERE rowid = ?", (row["id"],))
+                conn.execute(
+                    "INSERT INTO documents_fts (rowid, title, content) VALUES (?, ?, ?)",
+                    (row["id"], document["title"], document["content"])
+                )
+
+    def _clear(self, conn: sqlite3.Connection):
+        with transaction(conn):
+            conn.execute("DELETE FROM documents_fts")
+            conn.execute("DELETE FROM documents")
+
+    def _search(self, conn: sqlite3.Connection, q: str, nickname: str, date_from: str, date_to: str,
+                limit: int, offset: int) -> dict:
+        terms = q.split()
+        match_terms = [term for term in terms if len(term) >= MIN_MATCH_LENGTH]
+        conditions, params = [], []
+        if match_terms:
+            # 每个词作为一个短语, 词之间是 AND
+            conditions.append("documents_fts MATCH ?")
+            params.append(" AND ".join('"' + term.replace('"', '""') + '"' for term in match_terms))
+        for term in terms:
+            if len(term) < MIN_MATCH_LENGTH:
+                conditions.append("(documents_fts.title LIKE ? ESCAPE '\\' OR documents_fts.content LIKE ? ESCAPE '\\')")
+                params.extend([_like_pattern(term)] * 2)
+        if nickname:
+            conditions.append("d.nickname = ?")
+            params.append(nickname)
+        if date_from:
+            conditions.append("d.pub_time >= ?")
+            params.append(_time_bound(date_from, False))
+        if date_to:
+            conditions.append("d.pub_time <= ?")
+            params.append(_time_bound(date_to, True))
+        where = " AND ".join(conditions)
+        source = f"FROM documents_fts JOIN documents d ON d.id = documents_fts.rowid WHERE {where}"
+        if match_terms:
+            columns = (f"bm25(documents_fts, {TITLE_WEIGHT}, 1.0) AS score, "
+                       f"snippet(documents_fts, 1, '<mark>', '</mark>', '…', {SNIPPET_TOKENS}) AS snippet")
+            order = "score"
+            select_params = params
+        else:
+            # 没有可以用索引匹配的词时按发布时间排序, 摘要取第一个词附近的文字
+            columns = "NULL AS score, substr(documents_fts.content, max(instr(documents_fts.content, ?) - 20, 1), 100) AS snippet"
+            order = "d.pub_time DESC"
+            select_params = [terms[0], *params]
+        total = conn.execute(f"SELECT COUNT(*) {source}", params).fetchone()[0]
+        rows = conn.execute(
+            f"SELECT d.url, d.nickname, d.filename, d.title, d.pub_time, {columns} {source} "
+            f"ORDER BY {order} LIMIT ? OFFSET ?",
+            (*select_params, limit, offset)
+        ).fetchall()
+        return {"total": total, "results": [dict(row) for row in rows]}
+
+    async def add(self, article: dict, content, fmt: str = "html") -> bool:
+        """
+        把刚保存的文章加入索引, 解析页面在后台线程中进行, 返回是否提取到了文字
+        """
+        document = await asyncio.to_thread(article_document, article, content, fmt)
+        if document is None:
+            return False
+        await self._run(self._upsert, [document])
+        return True
+
+    async def add_documents(self, documents: list[dict]):
+        if documents:
+            await self._run(self._upsert, documents)
+
+    async def clear(self):
+        await self._run(self._clear)
+
+    async def count(self) -> int:
+        return await self._run(lambda conn: conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0])
+
+    async def search(self, q: str, nickname: str = None, date_from: str = None, date_to: str = None,
+                     limit: int = 20, offset: int = 0) -> dict:
+        """
+        搜索标题和正文, 多个词用空格分隔且都要出现, 结果按相关度排序
+        """
+        if not q or not q.strip():
+            raise ValueError("搜索词不能为空")
+        return await self._run(self._search, q, nickname, date_from, date_to, limit, offset)
+
+
+def open_search_index(settings: dict) -> SearchIndex:
+    """
+    [search] enabled = true 时返回全文索引, 否则返回 None
+    """
+    if settings.get("search", {}).get("enabled", "false") != "true":
+        return None
+    data_dir = settings["base"].get("data_dir") or DATA_DIR
+    return SearchIndex(os.path.join(data_dir, "search.db"))
+
+
+def load_document(job: tuple) -> dict:
+    """
+    在进程池中读取并解析一篇文章, 读取失败时返回 None
+    """
+    article, fmt, location = job
+    try:
+        if location[0] == "warc":
+            _, warc_path, offset, length = location
+            with open(warc_path, "rb") as f:
+                f.seek(offset)
+                content = f.read(length)
+        else:
+            with open(location[1], "rb") as f:
+                content = f.read()
+        return article_document(article, content, fmt)
+    except (OSError, ValueError, UnicodeError):
+        return None
+
+
+def reindex_jobs(article_index: ArticleIndex, output: FileOutput | WarcOutput, nickname: str = None) -> list[tuple]:
+    """
+    已下载的文章优先使用 html, 没有 html 时使用 mhtml
+    """
+    jobs = []
+    articles = article_index.with_format("html", nickname)
+    articles += [article for article in article_index.with_format("mhtml", nickname) if "html" not in article["formats"]]
+    for article in articles:
+        fmt = "html" if "html" in article["formats"] else "mhtml"
+        item = {"url": article["url"], "nickname": article["nickname"], "filename": article["filename"]}
+        if isinstance(output, WarcOutput):
+            archive = output.archive(article["nickname"])
+            entry = archive.find(article["filename"], fmt)
+            if entry is None:
+                continue
+            item["pub_time"] = entry.get("pub_time")
+            jobs.append((item, fmt, ("warc", archive.warc_path, entry["body_offset"], entry["body_length"])))
+        else:
+            path = output.path(article, fmt)
+            if not os.path.exists(path):
+                continue
+            # 保存时文件的修改时间设置成了发布时间
+            item["pub_time"] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(os.path.getmtime(path)))
+            jobs.append((item, fmt, ("file", path)))
+    return jobs
+
+
+async def reindex(search_index: SearchIndex, jobs: list[tuple], workers: int = None) -> int:
+    """
+    多进程解析文章, 每批解析完后写入索引, 返回写入的文章数量
+    """
+    loop = asyncio.get_running_loop()
+    count = 0
+    with ProcessPoolExecutor(workers) as pool:
+        for start in range(0, len(jobs), REINDEX_BATCH_SIZE):
+            batch = jobs[start:start + REINDEX_BATCH_SIZE]
+            documents = await asyncio.gather(*[loop.run_in_executor(pool, load_document, job) for job in batch])
+            documents = [document for document in documents if document is not None]
+            await search_index.add_documents(documents)
+            count += len(documents)
+            logger.info(f"已索引 {count} 篇, 进度 {min(start + REINDEX_BATCH_SIZE, len(jobs))}/{len(jobs)}")
+    return count
+
+
+async def run(settings: dict, args):
+    base = settings["base"]
+    data_dir = base.get("data_dir") or DATA_DIR
+    article_index = ArticleIndex(os.path.join(data_dir, "articles.db"))
+    search_index = SearchIndex(os.path.join(data_dir, "search.db"))
+    output = create_output(settings)
+    await article_index.open()
+    await search_index.open()
+    try:
+        await article_index.load()
+        if args.rebuild:
+            await search_index.clear()
+        jobs = reindex_jobs(article_index, output, args.nickname)
+        started = time.perf_counter()
+        count = await reindex(search_index, jobs, args.workers)
+        logger.info(f"索引完成, 共 {count} 篇文章, 耗时 {time.perf_counter() - started:.1f}s")
+    finally:
+        await output.close()
+        await search_index.close()
+        await article_index.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="为已下载的文章重建全文索引")
+    parser.add_argument("--rebuild", action="store_true", help="先清空索引")
+    parser.add_argument("--nickname", help="只索引该公众号的文章")
+    parser.add_argument("--workers", type=int, help="解析文章的进程数, 默认为 CPU 核数")
+    args = parser.parse_args()
+    logger.remove(handler_id=None)
+    logger.add(sys.stdout, level="INFO")
+    asyncio.run(run(read_ini_file(), args))
+
+
+if __name__ == "__main__":
+    main()
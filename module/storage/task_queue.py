@@ -0,0 +1,392 @@
+import json
+import time
+import asyncio
+import sqlite3
+from .base import SqliteStore, transaction, ensure_columns
+
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+TASK_STATES = (PENDING, RUNNING, DONE, FAILED, CANCELLED)
+# 租约过期或进程崩溃时仍在处理、且已经用完重试次数的任务记录的错误信息
+LEASE_EXPIRED_ERROR = "任务处理时间超过租约或进程异常退出, 已达到最大尝试次数"
+
+
+class TaskEvents:
+    """
+    任务状态变化的订阅, 每个订阅者一个有界队列, 消费过慢时丢弃事件
+    """
+    def __init__(self, maxsize: int = 1000):
+        self.maxsize = maxsize
+        self._subscribers: set[asyncio.Queue] = set()
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(self.maxsize)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+
+    def publish(self, event: dict):
+        for queue in self._subscribers:
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                pass
+
+
+class SqliteTaskQueue(SqliteStore):
+    """
+    持久化的下载任务队列, 任务状态: pending -> running -> done/failed, 未开始的任务可以取消
+
+    优先级高的任务先执行, 同一优先级内轮流执行不同公众号的任务;
+    running 状态的任务带有租约, 进程崩溃后通过 recover 或租约过期重新回到 pending
+    """
+    schema = """
+    CREATE TABLE IF NOT EXISTS tasks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        payload TEXT NOT NULL,
+        state TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        lease_until REAL,
+        error TEXT,
+        dedupe_key TEXT,
+        priority INTEGER NOT NULL DEFAULT 0,
+        account TEXT NOT NULL DEFAULT '',
+        job_id TEXT,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_tasks_state ON tasks(state, id);
+    CREATE TABLE IF NOT EXISTS account_turns (
+        account TEXT PRIMARY KEY,
+        last_served REAL NOT NULL
+    );
+    """
+    columns = ("id", "state", "attempts", "error", "priority", "job_id", "created_at", "updated_at")
+
+    def __init__(self, path: str, lease_seconds: float = 600, max_attempts: int = 3, poll_interval: float = 1):
+        super().__init__(path)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.events = TaskEvents()
+        self._not_empty = asyncio.Event()
+        # 本进程领取的任务, 心跳时延长租约
+        self._leased: set[int] = set()
+        self._watched: dict[tuple, float] = {}
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = super()._connect()
+        ensure_columns(conn, "tasks", {
+            "dedupe_key": "TEXT",
+            "priority": "INTEGER NOT NULL DEFAULT 0",
+            "account": "TEXT NOT NULL DEFAULT ''",
+            "job_id": "TEXT",
+        })
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_job ON tasks(job_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_dedupe ON tasks(dedupe_key, state)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_schedule ON tasks(state, priority, account, id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_updated ON tasks(updated_at)")
+        return conn
+
+    def _insert(self, conn: sqlite3.Connection, tasks: list[dict], dedupe_keys: list[str],
+                priorities: list[int], accounts: list[str], job_id: str) -> list[int]:
+        now = time.time()
+        ids = []
+        with transaction(conn):
+            for task, dedupe_key, priority, account in zip(tasks, dedupe_keys, priorities, accounts):
+                if dedupe_key and conn.execute(
+                    "SELECT 1 FROM tasks WHERE dedupe_key = ? AND state IN (?, ?) LIMIT 1",
+                    (dedupe_key, PENDING, RUNNING)
+                ).fetchone():
+                    ids.append(None)
+                    continue
+                cursor = conn.execute(
+                    "INSERT INTO tasks (payload, dedupe_key, priority, account, job_id, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (json.dumps(task, ensure_ascii=False), dedupe_key, priority or 0, account or "", job_id, now, now)
+                )
+                ids.append(cursor.lastrowid)
+        return ids
+
+    def _next_task_id(self, conn: sqlite3.Connection, now: float) -> int:
+        # 租约过期的任务优先重新领取
+        row = conn.execute(
+            "SELECT id FROM tasks WHERE state = ? AND lease_until < ? ORDER BY id LIMIT 1",
+            (RUNNING, now)
+        ).fetchone()
+        if row is not None:
+            return row["id"]
+        priority = conn.execute("SELECT MAX(priority) FROM tasks WHERE state = ?", (PENDING,)).fetchone()[0]
+        if priority is None:
+            return None
+        # 同一优先级中每个公众号最早的任务, 选择最久没有被处理过的公众号
+        row = conn.execute(
+            "SELECT t.task_id FROM ("
+            "  SELECT account, MIN(id) AS task_id FROM tasks WHERE state = ? AND priority = ? GROUP BY account"
+            ") t LEFT JOIN account_turns a ON a.account = t.account "
+            "ORDER BY COALESCE(a.last_served, 0), t.task_id LIMIT 1",
+            (PENDING, priority)
+        ).fetchone()
+        return row["task_id"]
+
+    def _fail_exhausted(self, conn: sqlite3.Connection, expired_before: float = None) -> list[dict]:
+        # 与 _fail 相同, 尝试次数用完的任务标记失败; 每次处理都卡死或让进程崩溃的文章不会被无限次重新领取
+        sql = (
+            "UPDATE tasks SET state = ?, error = ?, lease_until = NULL, updated_at = ? "
+            "WHERE state = ? AND attempts >= ?"
+        )
+        params = [FAILED, LEASE_EXPIRED_ERROR, time.time(), RUNNING, self.max_attempts]
+        if expired_before is not None:
+            sql += " AND lease_until < ?"
+            params.append(expired_before)
+        rows = conn.execute(sql + " RETURNING id, payload, state, attempts, error", params).fetchall()
+        return [self._event(row) for row in rows]
+
+    def _claim(self, conn: sqlite3.Connection) -> tuple[dict, list[dict]]:
+        now = time.time()
+        with transaction(conn):
+            failed = self._fail_exhausted(conn, now)
+            task_id = self._next_task_id(conn, now)
+            if task_id is None:
+                return None, failed
+            row = conn.execute(
+                "UPDATE tasks SET state = ?, attempts = attempts + 1, lease_until = ?, updated_at = ? WHERE id = ? "
+                "RETURNING id, payload, attempts, account",
+                (RUNNING, now + self.lease_seconds, now, task_id)
+            ).fetchone()
+            conn.execute(
+                "INSERT INTO account_turns (account, last_served) VALUES (?, ?) "
+                "ON CONFLICT(account) DO UPDATE SET last_served = excluded.last_served",
+                (row["account"], now)
+            )
+        task = json.loads(row["payload"])
+        task["task_id"] = row["id"]
+        task["attempts"] = row["attempts"]
+        return task, failed
+
+    def _set_state(self, conn: sqlite3.Connection, task_id: int, state: str, error: str = None, attempts_delta: int = 0) -> dict:
+        row = conn.execute(
+            "UPDATE tasks SET state = ?, error = ?, lease_until = NULL, attempts = attempts + ?, updated_at = ? "
+            "WHERE id = ? RETURNING id, payload, state, attempts, error",
+            (state, error, attempts_delta, time.time(), task_id)
+        ).fetchone()
+        return self._event(row)
+
+    def _event(self, row: sqlite3.Row) -> dict:
+        if row is None:
+            return None
+        payload = json.loads(row["payload"])
+        return {
+            "task_id": row["id"],
+            "state": row["state"],
+            "attempts": row["attempts"],
+            "error": row["error"],
+            "url": payload.get("url"),
+            "title": payload.get("title"),
+        }
+
+    def _fail(self, conn: sqlite3.Connection, task_id: int, error: str) -> dict:
+        with transaction(conn):
+            row = conn.execute("SELECT attempts FROM tasks WHERE id = ?", (task_id,)).fetchone()
+            retry = row is not None and row["attempts"] < self.max_attempts
+            return self._set_state(conn, task_id, PENDING if retry else FAILED, error)
+
+    def _cancel(self, conn: sqlite3.Connection, task_id: int) -> dict:
+        row = conn.execute(
+            "UPDATE tasks SET state = ?, updated_at = ? WHERE id = ? AND state = ? "
+            "RETURNING id, payload, state, attempts, error",
+            (CANCELLED, time.time(), task_id, PENDING)
+        ).fetchone()
+        return self._event(row)
+
+    def _touch(self, conn: sqlite3.Connection, task_ids: list[int]) -> int:
+        cursor = conn.execute(
+            f"UPDATE tasks SET lease_until = ? WHERE state = ? AND id IN ({', '.join('?' * len(task_ids))})",
+            (time.time() + self.lease_seconds, RUNNING, *task_ids)
+        )
+        return cursor.rowcount
+
+    def _changes(self, conn: sqlite3.Connection, since: float) -> list[sqlite3.Row]:
+        # 重试的任务回到 pending 并带有错误信息, requeue 放回的任务没有错误信息, 不产生事件
+        return conn.execute(
+            "SELECT id, payload, state, attempts, error, updated_at FROM tasks "
+            "WHERE updated_at > ? AND (state IN (?, ?) OR (state = ? AND error IS NOT NULL)) ORDER BY updated_at",
+            (since, DONE, FAILED, PENDING)
+        ).fetchall()
+
+    def _recover(self, conn: sqlite3.Connection) -> tuple[int, list[dict]]:
+        with transaction(conn):
+            failed = self._fail_exhausted(conn)
+            cursor = conn.execute(
+                "UPDATE tasks SET state = ?, lease_until = NULL, updated_at = ? WHERE state = ?",
+                (PENDING, time.time(), RUNNING)
+            )
+        return cursor.rowcount, failed
+
+    def _count(self, conn: sqlite3.Connection, state: str) -> int:
+        return conn.execute("SELECT COUNT(*) FROM tasks WHERE state = ?", (state,)).fetchone()[0]
+
+    def _counts(self, conn: sqlite3.Connection) -> dict:
+        counts = dict.fromkeys(TASK_STATES, 0)
+        counts.update(conn.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state").fetchall())
+        return counts
+
+    def _row_to_task(self, row: sqlite3.Row) -> dict:
+        task = {column: row[column] for column in self.columns}
+        task.update(json.loads(row["payload"]))
+        task["task_id"] = task.pop("id")
+        return task
+
+    def _get_task(self, conn: sqlite3.Connection, task_id: int) -> dict:
+        row = conn.execute(f"SELECT {', '.join(self.columns)}, payload FROM tasks WHERE id = ?", (task_id,)).fetchone()
+        return self._row_to_task(row) if row is not None else None
+
+    def _list_tasks(self, conn: sqlite3.Connection, state: str, job_id: str, limit: int, offset: int) -> list[dict]:
+        sql = f"SELECT {', '.join(self.columns)}, payload FROM tasks"
+        conditions, params = [], []
+        if state:
+            conditions.append("state = ?")
+            params.append(state)
+        if job_id:
+            conditions.append("job_id = ?")
+            params.append(job_id)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY id DESC LIMIT ? OFFSET ?"
+        rows = conn.execute(sql, (*params, limit, offset)).fetchall()
+        return [self._row_to_task(row) for row in rows]
+
+    def _publish(self, event: dict):
+        if event is not None:
+            self.events.publish(event)
+
+    async def put(self, task: dict, dedupe_key: str = None, priority: int = 0, account: str = None) -> int:
+        return (await self.put_many([task], [dedupe_key], [priority], [account]))[0]
+
+    async def put_many(self, tasks: list[dict], dedupe_keys: list[str] = None, priorities: list[int] = None,
+                       accounts: list[str] = None, job_id: str = None) -> list[int]:
+        """
+        批量添加任务, 队列中已有相同 dedupe_key 的未完成任务时跳过, 对应位置返回 None
+        """
+        if not tasks:
+            return []
+        empty = [None] * len(tasks)
+        ids = await self._run(self._insert, tasks, dedupe_keys or empty, priorities or empty, accounts or empty, job_id)
+        self._not_empty.set()
+        return ids
+
+    async def get(self, timeout: float = None) -> dict:
+        """
+        领取一个任务, 超时返回 None
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            self._not_empty.clear()
+            task, failed = await self._run(self._claim)
+            for event in failed:
+                self._publish(event)
+            if task is not None:
+                self._leased.add(task["task_id"])
+                return task
+            wait = self.poll_interval
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                wait = min(wait, remaining)
+            try:
+                await asyncio.wait_for(self._not_empty.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def done(self, task_id: int):
+        self._leased.discard(task_id)
+        self._publish(await self._run(self._set_state, task_id, DONE))
+
+    async def fail(self, task_id: int, error: str = None) -> bool:
+        """
+        标记任务失败, 未超过最大重试次数时放回队列, 返回是否会重试
+        """
+        self._leased.discard(task_id)
+        event = await self._run(self._fail, task_id, error)
+        self._publish(event)
+        retry = event is not None and event["state"] == PENDING
+        if retry:
+            self._not_empty.set()
+        return retry
+
+    async def requeue(self, task_id: int):
+        # 被中断的任务放回队列, 不计入重试次数
+        self._leased.discard(task_id)
+        await self._run(self._set_state, task_id, PENDING, None, -1)
+        self._not_empty.set()
+
+    async def cancel(self, task_id: int) -> bool:
+        """
+        取消还未开始的任务, 返回是否取消成功
+        """
+        event = await self._run(self._cancel, task_id)
+        self._publish(event)
+        return event is not None
+
+    async def recover(self) -> int:
+        """
+        上次异常退出时正在处理的任务放回队列, 已经用完尝试次数的标记失败, 返回放回的数量
+        """
+        recovered, failed = await self._run(self._recover)
+        for event in failed:
+            self._publish(event)
+        return recovered
+
+    async def touch(self, task_ids: list[int] = None) -> int:
+        """
+        延长本进程正在处理的任务的租约, 处理时间超过租约的任务不会被其他 worker 重复领取; 不指定 task_ids 时延长全部
+        """
+        task_ids = list(self._leased) if task_ids is None else task_ids
+        if not task_ids:
+            return 0
+        return await self._run(self._touch, task_ids)
+
+    async def heartbeat(self, interval: float = None):
+        interval = interval or max(self.lease_seconds / 3, 1)
+        while True:
+            await asyncio.sleep(interval)
+            await self.touch()
+
+    async def watch(self, interval: float = 1, window: float = 5):
+        """
+        其他进程处理任务时事件不经过本进程, 定时从数据库读取状态变化并发布;
+        各进程的时钟和提交顺序可能有先后, 每次多读 window 秒并按 (id, updated_at) 去重
+        """
+        since = time.time()
+        while True:
+            await asyncio.sleep(interval)
+            for row in await self._run(self._changes, since - window):
+                key = (row["id"], row["updated_at"])
+                if key in self._watched:
+                    continue
+                self._watched[key] = row["updated_at"]
+                since = max(since, row["updated_at"])
+                self._publish(self._event(row))
+            self._watched = {key: updated for key, updated in self._watched.items() if updated > since - window}
+
+    async def qsize(self) -> int:
+        return await self._run(self._count, PENDING)
+
+    async def counts(self) -> dict:
+        """
+        各状态的任务数量
+        """
+        return await self._run(self._counts)
+
+    async def get_task(self, task_id: int) -> dict:
+        return await self._run(self._get_task, task_id)
+
+    async def list_tasks(self, state: str = None, job_id: str = None, limit: int = 100, offset: int = 0) -> list[dict]:
+        return await self._run(self._list_tasks, state, job_id, limit, offset)
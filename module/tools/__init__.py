@@ -1,17 +1,42 @@
-import os
-import sys
-from loguru import logger
-import configparser
-from ..settings import ROOT_DIR
-
-def read_ini_file():
-    config_path = os.path.join(ROOT_DIR, "config.ini")
-    if not os.path.exists(config_path):
-        return {}
-    config = configparser.ConfigParser()
-    config.read(config_path)
-    config_dict = {}
-    for section in config.sections():
-        config_dict[section] = dict(config.items(section))
-    logger.info(f"读取配置文件: {config_path}, 配置内容: {config_dict}")
-    return config_dict
\ No newline at end of file
+import os
+import sys
+import shutil
+from loguru import logger
+import configparser
+from ..settings import ROOT_DIR, DATA_DIR, CONFIG_PATH
+
+def read_ini_file():
+    config_path = CONFIG_PATH
+    if not os.path.exists(config_path):
+        return {}
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    config_dict = {}
+    for section in config.sections():
+        config_dict[section] = dict(config.items(section))
+    logger.info(f"读取配置文件: {config_path}, 配置内容: {config_dict}")
+    return config_dict
+
+def setup_logger(filename: str, log_level: str = "INFO"):
+    logger.remove(handler_id=None)
+    log_path = os.path.join(ROOT_DIR, "logger")
+    os.makedirs(log_path, exist_ok=True)
+    logger.add(sys.stdout,  level=log_level)
+    logger.add(os.path.join(log_path, filename),  level=log_level, compression="zip", rotation="1 days")
+
+def prepare_metrics_dir(settings: dict):
+    """
+    多进程下载时各进程的监控指标写到同一个目录, 由 API 进程汇总, 必须在导入 prometheus_client 之前调用
+    """
+    base = settings.get("base", {})
+    # 子进程继承 API 进程设置的环境变量, 不再清空目录
+    if int(base.get("processes") or 0) <= 1 or os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        return
+    metrics_dir = os.path.join(base.get("data_dir") or DATA_DIR, "prometheus")
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = metrics_dir
+
+def parse_download_types(settings: dict) -> list[str]:
+    download_type = settings.get("download_type") or "pdf,mhtml,html"
+    return [item.strip() for item in download_type.lower().split(",") if item.strip()]
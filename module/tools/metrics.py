@@ -0,0 +1,88 @@
+import os
+import json
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from loguru import logger
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest
+from prometheus_client import multiprocess
+
+
+# 各阶段耗时从几十毫秒的写文件到几十秒的打印 PDF 都有
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+
+STAGE_SECONDS = Histogram("article_stage_seconds", "下载文章各阶段耗时", ["stage"], buckets=STAGE_BUCKETS)
+TASK_SECONDS = Histogram("article_task_seconds", "单个任务从领取到保存完成的耗时", ["result"], buckets=STAGE_BUCKETS)
+STAGE_TIMEOUTS = Counter("article_stage_timeouts_total", "阶段超时次数", ["stage"])
+TASK_RESULTS = Counter("article_tasks_total", "任务处理结果", ["result"])
+BYTES_WRITTEN = Counter("article_bytes_written_total", "保存的文件大小", ["format"])
+# 多进程下载时 gauge 按进程汇总: 正在处理的任务和内存取存活进程之和, 队列深度由 API 进程写入
+TASKS_IN_FLIGHT = Gauge("article_tasks_in_flight", "正在处理的任务数量", multiprocess_mode="livesum")
+QUEUE_DEPTH = Gauge("task_queue_depth", "队列中各状态的任务数量", ["queue", "state"], multiprocess_mode="mostrecent")
+BROWSER_RESTARTS = Counter("browser_restarts_total", "浏览器回收重启次数")
+BROWSER_RSS = Gauge("browser_rss_bytes", "浏览器所有进程占用的内存", multiprocess_mode="livesum")
+
+def export_metrics() -> bytes:
+    """
+    多进程下载时汇总 PROMETHEUS_MULTIPROC_DIR 中各进程的指标
+    """
+    if not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+
+_current_trace: ContextVar["TaskTrace"] = ContextVar("current_trace", default=None)
+
+
+class TaskTrace:
+    """
+    单个任务各阶段的耗时, 开启 [logger] trace 后任务结束时以 JSON 写入日志
+    """
+    def __init__(self, task: dict, worker_id=0, emit: bool = False):
+        self.task_id = task.get("task_id")
+        self.url = task.get("url")
+        self.worker_id = worker_id
+        self.started = time.perf_counter()
+        self.stages: dict[str, float] = {}
+        self.emit = emit
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = round(self.stages.get(stage, 0) + seconds, 4)
+
+    def finish(self, result: str):
+        total = time.perf_counter() - self.started
+        TASK_SECONDS.labels(result).observe(total)
+        TASK_RESULTS.labels(result).inc()
+        if self.emit:
+            logger.info("task_trace " + json.dumps({
+                "task_id": self.task_id,
+                "worker": self.worker_id,
+                "url": self.url,
+                "result": result,
+                "total": round(total, 4),
+                "stages": self.stages,
+            }, ensure_ascii=False))
+
+
+def start_trace(task: dict, worker_id=0, emit: bool = False) -> TaskTrace:
+    trace = TaskTrace(task, worker_id, emit)
+    _current_trace.set(trace)
+    return trace
+
+
+def observe_stage(stage: str, seconds: float):
+    STAGE_SECONDS.labels(stage).observe(seconds)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(stage, seconds)
+
+
+@contextmanager
+def stage_timer(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)